@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Counters and latency histograms for Treeherder and S3 submission"""
+
+import json
+import logging
+from platform import node
+import socket
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Endpoint names used by TreeherderSubmission and S3Bucket
+RESULTSET_LOOKUP = 'resultset_lookup'
+JOBS_LOOKUP = 'jobs_lookup'
+COLLECTION_POST = 'collection_post'
+S3_PUT = 's3_put'
+LOCAL_PUT = 'local_put'
+
+
+class SubmissionMetrics(object):
+    """ Per-endpoint request, retry, failure and byte counters plus latency
+    histograms, written as json at the end of a run and optionally pushed to
+    a statsd-style UDP sink as they are recorded.
+    """
+    # Upper bounds, in seconds, of the latency histogram buckets; the last
+    # bucket counts everything slower.
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, statsd_address=None, statsd_prefix='mozplatformqa'):
+        """
+        statsd_address - optional 'host:port' of a statsd UDP listener
+        """
+        self.started = time.time()
+        self.endpoints = {}
+        self._lock = threading.Lock()
+        self._statsd = None
+        self.statsd_prefix = statsd_prefix
+        if statsd_address:
+            host, port = statsd_address.rsplit(':', 1)
+            self._statsd = (host, int(port))
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                'requests': 0,
+                'retries': 0,
+                'failures': 0,
+                'bytes_sent': 0,
+                'latency': {
+                    'buckets': list(self.LATENCY_BUCKETS) + ['+Inf'],
+                    'counts': [0] * (len(self.LATENCY_BUCKETS) + 1),
+                    'sum': 0.0,
+                    'max': 0.0,
+                },
+            }
+        return self.endpoints[endpoint]
+
+    def record(self, endpoint, latency, bytes_sent=0, failed=False):
+        """ Record one request to `endpoint` that took `latency` seconds. """
+        with self._lock:
+            e = self._endpoint(endpoint)
+            e['requests'] += 1
+            e['bytes_sent'] += bytes_sent
+            if failed:
+                e['failures'] += 1
+            h = e['latency']
+            i = 0
+            while (i < len(self.LATENCY_BUCKETS) and
+                   latency > self.LATENCY_BUCKETS[i]):
+                i += 1
+            h['counts'][i] += 1
+            h['sum'] += latency
+            h['max'] = max(h['max'], latency)
+        self._send(endpoint, [('requests', 1, 'c'),
+                              ('latency', int(latency * 1000), 'ms'),
+                              ('bytes_sent', bytes_sent, 'c'),
+                              ('failures', int(failed), 'c')])
+
+    def retry(self, endpoint):
+        """ Record that a request to `endpoint` is being retried. """
+        with self._lock:
+            self._endpoint(endpoint)['retries'] += 1
+        self._send(endpoint, [('retries', 1, 'c')])
+
+    def _send(self, endpoint, stats):
+        if not self._statsd:
+            return
+        lines = ['%s.%s.%s:%d|%s' % (self.statsd_prefix, endpoint, name,
+                                     value, kind)
+                 for name, value, kind in stats]
+        try:
+            self._socket.sendto('\n'.join(lines), self._statsd)
+        except socket.error:
+            logger.debug('Unable to send metrics to statsd at %s:%d' %
+                         self._statsd)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'host': node(),
+                'started': self.started,
+                'finished': time.time(),
+                'endpoints': json.loads(json.dumps(self.endpoints)),
+            }
+
+    def write(self, path):
+        """ Write the collected metrics as json to `path`. """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=4, separators=(',', ': '))
@@ -37,6 +37,16 @@ class ParserBase(object):
         """Parse a single line of the log"""
         raise NotImplementedError
 
+    def strip_prefix(self, line):
+        """Return the match of the mozharness prefix of `line`, if any, and
+        the line without it."""
+        # the prefix starts with a date; skip the regex for other lines
+        if line[:1].isdigit():
+            prefix_match = self.RE_MOZHARNESS_PREFIX.match(line)
+            if prefix_match:
+                return prefix_match, line[prefix_match.end():]
+        return None, line
+
     def get_artifact(self):
         """By default, just return the artifact as-is."""
         return self.artifact
@@ -116,6 +126,8 @@ class MozharnessStepParser(ParserBase):
         '$'
     ]))
     RE_SKIP_END = re.compile(r'#{5}$')
+    # every step start and end line starts with this
+    STEP_MARKER = '#####'
 
     def __init__(self):
         super(MozharnessStepParser, self).__init__("step_data")
@@ -133,13 +145,12 @@ class MozharnessStepParser(ParserBase):
 
     def parse_line(self, line, lineno):
         """ Parse a single line of the log """
-        prefix_match = self.RE_MOZHARNESS_PREFIX.match(line)
-        if prefix_match:
-            trimline = self.RE_MOZHARNESS_PREFIX.sub('', line)
-        else:
-            trimline = line
+        prefix_match, trimline = self.strip_prefix(line)
+        is_marker = trimline.startswith(self.STEP_MARKER)
         # Check start of step
         if not self.state == self.ST_STARTED:
+            if not is_marker:
+                return
             match = (self.RE_STEP_START.match(trimline) or
                      self.RE_SKIP_START.match(trimline))
             if match:
@@ -162,9 +173,10 @@ class MozharnessStepParser(ParserBase):
             return
 
         # Check end of step
-        if self.skipping:
+        match = None
+        if is_marker and self.skipping:
             match = self.RE_SKIP_END.match(trimline)
-        else:
+        elif is_marker:
             match = (self.RE_STEP_END.match(trimline) or
                      self.RE_TEST_END.match(trimline))
         if match:
@@ -193,7 +205,7 @@ class MozharnessStepParser(ParserBase):
             return
 
         # Check middle of step
-        self.sub_parser.parse_line(line, lineno)
+        self.sub_parser.parse_trimmed_line(trimline, lineno)
 
     @property
     def steps(self):
@@ -241,6 +253,14 @@ class ErrorParser(ParserBase):
                             r'(Automation Error: )|'
                             r'(AssertionError: )|'
                             r'(Failure)')
+    # Lines failure_re can match start with one of these or contain
+    # 'CRASH: '; other lines are not matched against it.
+    FAILURE_PREFIXES = ('TEST-UNEXPECTED-FAIL',
+                        'TEST-UNEXPECTED-ERROR',
+                        'Crash reason: ',
+                        'Automation Error: ',
+                        'AssertionError: ',
+                        'Failure')
 
     def __init__(self):
         super(ErrorParser, self).__init__("errors")
@@ -253,8 +273,12 @@ class ErrorParser(ParserBase):
 
     def parse_line(self, line, lineno):
         # Remove mozharness prefixes prior to matching
-        trimline = re.sub(self.RE_MOZHARNESS_PREFIX, '', line)
-        if self.failure_re.match(trimline):
+        self.parse_trimmed_line(self.strip_prefix(line)[1], lineno)
+
+    def parse_trimmed_line(self, trimline, lineno):
+        """Parse a line whose mozharness prefix is already removed"""
+        if ((trimline.startswith(self.FAILURE_PREFIXES) or
+             'CRASH: ' in trimline) and self.failure_re.match(trimline)):
             self.add(trimline, lineno)
 
 
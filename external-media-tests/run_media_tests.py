@@ -18,7 +18,10 @@
     - On Windows, the mozilla-build system
     - Treeherder-related actions require:
       - treeherding.py
-      - s3.py
+      - platforms.json
+      - metrics.py
+      - storage.py
+      - s3.py (unless the credentials file selects the local backend)
 """
 import copy
 import json
@@ -85,6 +88,46 @@ treeherding_config_options = [
       "dest": "s3_credentials_path",
       "help": "Path to credentials json file",
       }],
+    [["--treeherder-metrics"],
+     {"action": "store",
+      "dest": "treeherder_metrics_path",
+      "default": "",
+      "help": "Path of json file to write submission metrics to.",
+      }],
+    [["--submission-journal"],
+     {"action": "store",
+      "dest": "submission_journal",
+      "default": "",
+      "help": ("Path of json file recording posted states and uploads, "
+               "so a re-run only submits what is missing."),
+      }],
+    [["--content-addressed-uploads"],
+     {"action": "store_true",
+      "dest": "content_addressed_uploads",
+      "default": False,
+      "help": ("Store uploads under content-addressed keys and skip "
+               "files already in the bucket."),
+      }],
+    [["--upload-max-file-size"],
+     {"action": "store",
+      "type": "int",
+      "dest": "upload_max_file_size",
+      "default": 0,
+      "help": "Truncate uploaded files to this many bytes; 0 for no cap.",
+      }],
+    [["--upload-max-job-size"],
+     {"action": "store",
+      "type": "int",
+      "dest": "upload_max_job_size",
+      "default": 0,
+      "help": "Cap on bytes uploaded per job; 0 for no cap.",
+      }],
+    [["--statsd-address"],
+     {"action": "store",
+      "dest": "statsd_address",
+      "default": "",
+      "help": "host:port of statsd UDP sink for submission metrics.",
+      }],
 ]
 
 
@@ -191,6 +234,15 @@ class TreeherdingMixin(object):
         c = self.config
         options = TreeherderOptions()
         options.treeherder_url = c['treeherder_url']
+        options.treeherder_journal_path = c.get('submission_journal', '')
+        options.treeherder_metrics_path = c.get('treeherder_metrics_path', '')
+        options.treeherder_statsd_address = c.get('statsd_address', '')
+        options.treeherder_content_addressed_uploads = c.get(
+            'content_addressed_uploads', False)
+        options.treeherder_upload_max_file_size = c.get(
+            'upload_max_file_size', 0)
+        options.treeherder_upload_max_job_size = c.get(
+            'upload_max_job_size', 0)
         dirs = self.query_abs_dirs()
         credentials_path = os.path.join(dirs['base_work_dir'],
                                         c['treeherder_credentials_path'])
@@ -206,13 +258,14 @@ class TreeherdingMixin(object):
         return options
 
     def _get_s3_bucket(self):
-        """ Returns S3Bucket instance populated based on config.
+        """ Returns the storage backend (an S3Bucket unless the
+        credentials file selects another backend) populated based on config.
 
         Prerequisite: A venv has been created and necessary packages have been
         installed.
         """
-        self.info("Setting up S3Bucket.")
-        from s3 import S3Bucket
+        self.info("Setting up storage backend.")
+        from storage import open_storage
         c = self.config
         dirs = self.query_abs_dirs()
         credentials_path = os.path.join(dirs['base_work_dir'],
@@ -221,10 +274,7 @@ class TreeherdingMixin(object):
             with open(credentials_path) as f:
                 config_string = f.read()
                 s3_config = json.loads(config_string)
-                return S3Bucket(s3_config['s3_bucket_name'],
-                                s3_config['aws_access_key_id'],
-                                s3_config['aws_access_key'],
-                                self.log_obj.logger)
+                return open_storage(s3_config, self.log_obj.logger)
         except IOError:
             msg = ('S3 credentials file not '
                    'found at {0}.'.format(credentials_path))
@@ -286,7 +336,10 @@ class TreeherdingMixin(object):
         if self.config['treeherding_off'] or not self.treeherder:
             self.info("Treeherding is off or not set up; nothing to do.")
             return
-        self.treeherder.submit_complete([self.job])
+        try:
+            self.treeherder.submit_complete([self.job])
+        finally:
+            self.treeherder.finish()
         
 
 class FirefoxMediaTest(TreeherdingMixin, FirefoxMediaTestsBase):
@@ -431,6 +484,8 @@ class FirefoxMediaTest(TreeherdingMixin, FirefoxMediaTestsBase):
         from treeherding import TestJob
 
         class JenkinsJob(TestJob):
+            __slots__ = ('jenkins_build_tag', 'jenkins_build_url')
+
             def __init__(self, **kwargs):
                 super(JenkinsJob, self).__init__(**kwargs)
                 self.jenkins_build_tag = ''  # computed
@@ -465,6 +520,11 @@ class FirefoxMediaTest(TreeherdingMixin, FirefoxMediaTestsBase):
         self.job.jenkins_build_tag = c['jenkins_build_tag']
         self.job.jenkins_build_url = c['jenkins_build_url']
         self.job.name = c['jenkins_build_tag']
+        if c.get('submission_journal') and c['jenkins_build_tag']:
+            # A re-run of this build must reuse the guid the journal has
+            # recorded
+            from treeherding import stable_job_guid
+            self.job.job_guid = stable_job_guid(c['jenkins_build_tag'])
         if c['jenkins_build_url']:
             self.job.job_details.append({
                         'url': self.job.jenkins_build_url,
@@ -4,88 +4,581 @@
 
 # based on https://github.com/mozilla/autophone/blob/master/s3.py
 
-import gzip
+import calendar
+import collections
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import io
+import itertools
+import json
+import math
+import mimetypes
+from multiprocessing.pool import ThreadPool
 import os
 import re
-import tempfile
+import threading
+import time
+import urlparse
+import zlib
 
 import boto
 import boto.s3.connection
+import boto.utils
+from boto.s3.multipart import MultiPartUpload
+from boto.s3.prefix import Prefix
 
-class S3Error(Exception):
+from metrics import S3_PUT
+from storage import StorageBackend, StorageError, literal_prefix, write_json
+
+try:
+    import brotli
+except ImportError:
+    # brotli encoding is optional
+    brotli = None
+
+class S3Error(StorageError):
     def __init__(self, message):
         Exception.__init__(self, 'S3Error: %s' % message)
 
-class S3Bucket(object):
+# Connections and bucket handles are shared by every S3Bucket in the
+# process. boto connections are not thread-safe, so each thread keeps its
+# own, keyed by credentials and endpoint (and bucket name for bucket
+# handles). Buckets are checked to exist only the first time they are used
+# in the process.
+_handles = threading.local()
+_known_buckets = set()
+_known_buckets_lock = threading.Lock()
+
+def get_connection(access_key_id, access_secret_key, endpoint=None):
+    """ Return the current thread's S3Connection for the credentials.
+    `endpoint` is the url of an S3-compatible server to use instead of AWS,
+    e.g. http://localhost:9000.
+    """
+    connections = _handles.__dict__.setdefault('connections', {})
+    credentials = (access_key_id, access_secret_key, endpoint)
+    conn = connections.get(credentials)
+    if conn is None:
+        kwargs = {}
+        if endpoint:
+            parsed = urlparse.urlparse(endpoint)
+            kwargs = {
+                'host': parsed.hostname,
+                'port': parsed.port,
+                'is_secure': parsed.scheme == 'https',
+                'calling_format': boto.s3.connection.OrdinaryCallingFormat(),
+            }
+        conn = boto.s3.connection.S3Connection(access_key_id,
+                                               access_secret_key,
+                                               **kwargs)
+        connections[credentials] = conn
+    return conn
+
+def get_bucket(bucket_name, access_key_id, access_secret_key, endpoint=None):
+    """ Return the current thread's handle on bucket `bucket_name`. """
+    buckets = _handles.__dict__.setdefault('buckets', {})
+    handle_key = (access_key_id, access_secret_key, endpoint, bucket_name)
+    bucket = buckets.get(handle_key)
+    if bucket is None:
+        conn = get_connection(access_key_id, access_secret_key, endpoint)
+        with _known_buckets_lock:
+            known = handle_key in _known_buckets
+        if not known:
+            if not conn.lookup(bucket_name):
+                raise S3Error('bucket %s not found' % bucket_name)
+            with _known_buckets_lock:
+                _known_buckets.add(handle_key)
+        bucket = conn.get_bucket(bucket_name, validate=False)
+        buckets[handle_key] = bucket
+    return bucket
+
+
+def gzip_chunks(path, level=9, read_size=1024 * 1024):
+    """ Yield the gzip-compressed contents of `path` in chunks, reading and
+    compressing `read_size` bytes at a time.
+    """
+    # wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(read_size), ''):
+            chunk = compressor.compress(data)
+            if chunk:
+                yield chunk
+    yield compressor.flush()
+
+def brotli_chunks(path, quality=5, read_size=1024 * 1024):
+    """ Yield the brotli-compressed contents of `path` in chunks. """
+    compressor = brotli.Compressor(quality=quality)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(read_size), ''):
+            chunk = compressor.process(data)
+            if chunk:
+                yield chunk
+    yield compressor.finish()
+
+def file_chunks(path, read_size=1024 * 1024):
+    """ Yield the contents of `path` in chunks of `read_size` bytes. """
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(read_size), ''):
+            yield data
+
+# Formats which are already compressed are stored as is.
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.7z', '.apk', '.bz2', '.dmg', '.gif', '.gz', '.jar', '.jpeg', '.jpg',
+    '.mp3', '.mp4', '.ogg', '.ogv', '.png', '.tgz', '.webm', '.webp',
+    '.woff', '.woff2', '.xpi', '.xz', '.zip',
+])
+# Files of other types are stored as is if a sample of their first
+# SNIFF_SIZE bytes has more than MAX_ENTROPY bits per byte.
+SNIFF_SIZE = 64 * 1024
+MAX_ENTROPY = 7.5
+# (maximum file size, gzip level, brotli quality); bigger files get faster
+# settings.
+COMPRESSION_LEVELS = (
+    (1024 * 1024, 9, 9),
+    (16 * 1024 * 1024, 6, 5),
+    (None, 4, 3),
+)
+CONTENT_TYPES = {
+    '.log': 'text/plain',
+    '.txt': 'text/plain',
+}
+
+def byte_entropy(data):
+    """ Return the Shannon entropy of string `data` in bits per byte. """
+    size = float(len(data))
+    return -sum(count / size * math.log(count / size, 2)
+                for count in collections.Counter(data).itervalues())
+
+def compression_policy(path, encoding='gzip', level=None):
+    """ Return (content_encoding, level) to upload `path` with, where
+    content_encoding is `encoding` ('gzip', or 'br' if brotli is
+    installed) or None if the file is not worth compressing.
+    A `level` overrides the size based COMPRESSION_LEVELS; level 0 stores
+    every file uncompressed.
+    """
+    if level == 0:
+        return None, None
+    if os.path.splitext(path)[-1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return None, None
+    with open(path, 'rb') as f:
+        sample = f.read(SNIFF_SIZE)
+    if len(sample) >= 1024 and byte_entropy(sample) > MAX_ENTROPY:
+        return None, None
+    size = os.path.getsize(path)
+    for max_size, gzip_level, brotli_quality in COMPRESSION_LEVELS:
+        if max_size is None or size <= max_size:
+            break
+    if encoding == 'br' and brotli:
+        return 'br', level or brotli_quality
+    return 'gzip', level or gzip_level
+
+def content_chunks(path, encoding, level):
+    """ Yield the contents of `path` encoded as given by
+    compression_policy.
+    """
+    if encoding == 'br':
+        return brotli_chunks(path, level)
+    if encoding == 'gzip':
+        return gzip_chunks(path, level)
+    return file_chunks(path)
+
+def file_sha1(path, read_size=1024 * 1024):
+    """ Return the hex sha1 digest of the contents of `path`. """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(read_size), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+def content_type(path):
+    """ Return the Content-Type to store `path` with, or None. """
+    ext = os.path.splitext(path)[-1].lower()
+    return CONTENT_TYPES.get(ext) or mimetypes.guess_type(path, False)[0]
+
+
+class UploadCheckpoint(object):
+    """ Progress of the uploads to one job prefix, kept as json in `path`
+    so that uploads retried after an aborted run skip files already stored
+    and resume multipart uploads after their last completed part. Entries
+    are keyed by source path and only used while the file's sha1 matches.
+    """
+    def __init__(self, path, logger):
+        self.path = path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self.data = {}
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except IOError:
+            pass
+        except ValueError:
+            self._logger.warning('Ignoring corrupt upload checkpoint %s' %
+                                 self.path)
+
+    def get(self, source, sha1):
+        entry = self.data.get(source)
+        if entry and entry['sha1'] == sha1:
+            return entry
+        return None
+
+    def start(self, source, sha1, key, encoding, level):
+        with self._lock:
+            entry = self.data[source] = {'sha1': sha1,
+                                         'key': key,
+                                         'encoding': encoding,
+                                         'level': level,
+                                         'upload_id': None,
+                                         'parts': {},
+                                         'url': None}
+            self._save()
+        return entry
+
+    def update(self, source, **values):
+        with self._lock:
+            self.data[source].update(values)
+            self._save()
 
-    def __init__(self, bucket_name, access_key_id, access_secret_key, logger):
+    def add_part(self, source, part_num, md5):
+        with self._lock:
+            self.data[source]['parts'][str(part_num)] = md5
+            self._save()
+
+    def _save(self):
+        try:
+            write_json(self.path, self.data, indent=1)
+        except (IOError, OSError):
+            self._logger.exception('Unable to write upload checkpoint %s' %
+                                   self.path)
+
+
+class S3Bucket(StorageBackend):
+    # Compressed data is buffered in memory up to this many bytes; larger
+    # outputs are sent as a multipart upload in parts of about this size
+    # (S3 requires at least 5 MB per part except the last one).
+    PART_SIZE = 8 * 1024 * 1024
+    # Parts of a multipart upload are sent concurrently by this many
+    # threads, and each part is tried up to PART_ATTEMPTS times.
+    MULTIPART_THREADS = 4
+    PART_ATTEMPTS = 3
+    # Keys are removed by multi-object delete requests of at most
+    # DELETE_BATCH_SIZE keys (the S3 limit), DELETE_THREADS at a time.
+    DELETE_BATCH_SIZE = 1000
+    DELETE_THREADS = 4
+    # Jobs are stored under repo/release/platform/arch/build_id/job_guid/;
+    # sweep() walks down to the build_id level with this many threads.
+    BUILD_ID_DEPTH = 4
+    BUILD_ID_FORMAT = '%Y%m%d%H%M%S'
+    SWEEP_THREADS = 8
+    # upload_dir() uploads this many files at a time
+    UPLOAD_DIR_THREADS = 8
+    # Checkpoints untouched for this many seconds are deleted; their uploads
+    # either finished or were abandoned long ago.
+    CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+
+    def __init__(self, bucket_name, access_key_id, access_secret_key, logger,
+                 metrics=None, encoding='gzip', checkpoint_dir=None,
+                 throttle=None, endpoint=None, compression_level=None):
         self.bucket_name = bucket_name
-        self._bucket = None
         self.access_key_id = access_key_id
         self.access_secret_key = access_secret_key
+        # optional url of an S3-compatible server to use instead of AWS
+        self.endpoint = endpoint
         self._logger = logger
+        # optional metrics.SubmissionMetrics recording each PUT
+        self.metrics = metrics
+        # preferred Content-Encoding of compressible files: 'gzip' or 'br'
+        self.encoding = encoding
+        # optional fixed level for compression_policy; 0 for none
+        self.compression_level = compression_level
+        # optional directory of UploadCheckpoint files, one per job prefix
+        self.checkpoint_dir = checkpoint_dir
+        self._checkpoints = {}
+        self._checkpoints_lock = threading.Lock()
+        # optional storage.UploadThrottle limiting each PUT
+        self.throttle = throttle
 
     @property
     def bucket(self):
-        if self._bucket:
-            return self._bucket
+        """ The current thread's handle on the bucket. """
         try:
-            conn = boto.s3.connection.S3Connection(self.access_key_id,
-                                                   self.access_secret_key)
-            if not conn.lookup(self.bucket_name):
-                raise S3Error('bucket %s not found' % self.bucket_name)
-            if not self._bucket:
-                self._bucket = conn.get_bucket(self.bucket_name)
-            return self._bucket
+            return get_bucket(self.bucket_name, self.access_key_id,
+                              self.access_secret_key, self.endpoint)
         except boto.exception.NoAuthHandlerFound:
-            self._logger.exception()
+            self._logger.exception('Authentication failed')
             raise S3Error('Authentication failed')
         except boto.exception.S3ResponseError, e:
-            self._logger.exception()
+            self._logger.exception(str(e))
             raise S3Error('%s' % e)
 
-    def ls(self, keypattern='.*'):
-        if isinstance(keypattern, str):
+    def ls(self, keypattern='.*', prefix=None, delimiter=''):
+        """ Lazily list the keys matching `keypattern`. Only the part of
+        the bucket under `prefix` is listed, page by page; by default the
+        prefix is the literal start of `keypattern`. With a `delimiter`,
+        common prefixes are returned instead of the keys below them.
+        """
+        if isinstance(keypattern, basestring):
             keypattern = re.compile(keypattern)
-        keys = [key for key in self.bucket.list() if keypattern.match(key.name)]
-        return keys
+        if prefix is None:
+            prefix = literal_prefix(keypattern)
+        self._logger.debug('Listing keys with prefix: %s' % prefix)
+        for key in self.bucket.list(prefix=prefix, delimiter=delimiter):
+            if keypattern.match(key.name):
+                yield key
 
     def rm(self, keys):
-        assert isinstance(keys, list) or isinstance(keys, str)
-
-        if isinstance(keys, str):
+        """ Delete `keys`, a list of keys or key names, or the keys matching
+        a pattern string. Keys are deleted in concurrent batches; keys which
+        could not be deleted are logged and reported by raising S3Error once
+        all batches are done.
+        """
+        if isinstance(keys, basestring):
             keys = self.ls(keys)
+        keys = iter(keys)
+        pool = ThreadPool(self.DELETE_THREADS)
+        pending = []
+        failed = []
+        try:
+            while True:
+                batch = list(itertools.islice(keys, self.DELETE_BATCH_SIZE))
+                if not batch:
+                    break
+                pending.append(pool.apply_async(self._delete_batch, (batch,)))
+                # keep listing only a few batches ahead of the deletes
+                if len(pending) >= 2 * self.DELETE_THREADS:
+                    failed.extend(pending.pop(0).get())
+            for result in pending:
+                failed.extend(result.get())
+        except boto.exception.S3ResponseError, e:
+            self._logger.exception(str(e))
+            raise S3Error('%s' % e)
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            raise S3Error('unable to delete %d keys: %s%s' %
+                          (len(failed), ', '.join(failed[:10]),
+                           ', ...' if len(failed) > 10 else ''))
+
+    def _delete_batch(self, keys):
+        """ Delete `keys` with a single multi-object delete request and
+        return the names of the keys which could not be deleted.
+        """
+        result = self.bucket.delete_keys(keys, quiet=True)
+        for error in result.errors:
+            self._logger.warning('Unable to delete %s: %s %s' %
+                                 (error.key, error.code, error.message))
+        return [error.key for error in result.errors]
+
+    def sweep(self, cutoff, prefix='', exclude=('blobs/',), dry_run=False):
+        """ Delete every build under `prefix` whose build_id is older than
+        datetime `cutoff`, and return a list of dicts describing each
+        expired build: its prefix, build_id, number of keys and bytes, and
+        the names of keys which could not be deleted.
+
+        Prefixes are listed one level at a time, in parallel, down to the
+        build_id, so keys of builds which are kept are never listed.
+        `prefix` must be empty or end at a level, e.g. 'mozilla-central/'.
+        Top level prefixes in `exclude` are skipped; content addressed
+        blobs may be shared by newer jobs and are swept by sweep_blobs
+        instead. With `dry_run`, the expired builds are only reported.
+        """
+        prefixes = [prefix]
+        pool = ThreadPool(self.SWEEP_THREADS)
         try:
-            for key in keys:
-                key.delete()
+            for depth in range(prefix.count('/'), self.BUILD_ID_DEPTH + 1):
+                children = pool.map(self._child_prefixes, prefixes)
+                prefixes = [child for names in children for child in names
+                            if not child.startswith(exclude)]
+            expired = []
+            for build_prefix in prefixes:
+                build_id = build_prefix.rstrip('/').rsplit('/', 1)[-1]
+                try:
+                    build_time = datetime.strptime(build_id,
+                                                   self.BUILD_ID_FORMAT)
+                except ValueError:
+                    self._logger.debug('Skipping %s: build_id is not a '
+                                       'timestamp' % build_prefix)
+                    continue
+                if build_time < cutoff:
+                    expired.append(build_prefix)
+            self._logger.info('%d of %d builds are older than %s' %
+                              (len(expired), len(prefixes), cutoff))
+            return pool.map(lambda build_prefix:
+                            self._sweep_build(build_prefix, dry_run),
+                            expired)
         except boto.exception.S3ResponseError, e:
             self._logger.exception(str(e))
             raise S3Error('%s' % e)
+        finally:
+            pool.close()
+            pool.join()
+
+    def sweep_blobs(self, cutoff, prefix='blobs/', dry_run=False):
+        """ Delete the content addressed blobs under `prefix` which were
+        neither uploaded nor reused since datetime `cutoff`, and return a
+        dict like those returned by sweep.
 
-    def upload(self, path, destination):
+        upload() refreshes the last-modified time of a blob each time a job
+        reuses it, so a blob older than `cutoff` is only referenced by jobs
+        that ran before it, whose builds sweep deletes with the same cutoff.
+        """
+        cutoff_ts = time.mktime(cutoff.timetuple())
         try:
-            key = self.bucket.get_key(destination)
-            if not key:
-                self._logger.debug('Creating key: %s' % destination)
-                key = self.bucket.new_key(destination)
-
-            ext = os.path.splitext(path)[-1]
-            if ext == '.log' or ext == '.txt':
-                key.set_metadata('Content-Type', 'text/plain')
-
-            with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
-                self._logger.debug('Compressing: %s' % path)
-                with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
-                    with open(path, 'rb') as f:
-                        gz.writelines(f)
-                tf.flush()
-                tf.seek(0)
-                key.set_metadata('Content-Encoding', 'gzip')
-                self._logger.debug('Setting key contents from: %s' % tf.name)
-                key.set_contents_from_file(tf)
+            return self._sweep_build(
+                prefix, dry_run,
+                lambda key: calendar.timegm(boto.utils.parse_ts(
+                    key.last_modified).timetuple()) < cutoff_ts)
+        except boto.exception.S3ResponseError, e:
+            self._logger.exception(str(e))
+            raise S3Error('%s' % e)
+
+    def _child_prefixes(self, prefix):
+        """ Return the names of the prefixes one level below `prefix`. """
+        return [item.name for item in self.bucket.list(prefix=prefix,
+                                                       delimiter='/')
+                if isinstance(item, Prefix)]
+
+    def _sweep_build(self, prefix, dry_run, expired=None):
+        """ Delete, or with `dry_run` only count, the keys under `prefix`,
+        or only those for which `expired` returns True.
+        """
+        build = {'prefix': prefix,
+                 'build_id': prefix.rstrip('/').rsplit('/', 1)[-1],
+                 'keys': 0,
+                 'bytes': 0,
+                 'failed': []}
+        keys = iter(self.bucket.list(prefix=prefix))
+        if expired:
+            keys = itertools.ifilter(expired, keys)
+        while True:
+            batch = list(itertools.islice(keys, self.DELETE_BATCH_SIZE))
+            if not batch:
+                break
+            build['keys'] += len(batch)
+            build['bytes'] += sum(key.size for key in batch)
+            if not dry_run:
+                build['failed'].extend(self._delete_batch(batch))
+        return build
+
+    def upload(self, path, destination, overwrite=True,
+               checkpoint_prefix=None):
+        """ Upload `path`, compressed unless compression_policy says it is
+        not worth it, to key `destination` and return its url. If
+        `overwrite` is False and the key already exists, the existing
+        object is kept, its last-modified time refreshed (see sweep_blobs)
+        and its url returned.
+
+        With a checkpoint_dir, a file already uploaded under the same
+        `checkpoint_prefix` (by default the key prefix of `destination`)
+        with the same contents is not uploaded again, and an
+        interrupted multipart upload is resumed under its original key.
+        Interrupted multipart uploads are then left for the retry to
+        finish rather than cancelled; a bucket lifecycle rule should abort
+        stale ones.
+        """
+        try:
+            checkpoint = self._checkpoint(checkpoint_prefix or destination)
+            entry = None
+            if checkpoint:
+                sha1 = file_sha1(path)
+                entry = checkpoint.get(path, sha1)
+                if entry and entry['url']:
+                    self._logger.debug('File %s already uploaded to: %s' %
+                                       (path, entry['url']))
+                    return entry['url']
+                if entry:
+                    destination = entry['key']
+
+            # Only look for an existing key when it is to be kept; a PUT
+            # replaces any existing object anyway.
+            key = None
+            if not overwrite:
+                key = self.bucket.get_key(destination)
+            if key:
+                url = key.generate_url(expires_in=0, query_auth=False)
+                self._logger.debug('Key %s exists; not uploading %s' %
+                                   (destination, path))
+                self._touch(key)
+                return url
+            self._logger.debug('Creating key: %s' % destination)
+            key = self.bucket.new_key(destination)
+
+            if entry:
+                # a resumed upload must produce the same parts
+                encoding, level = entry['encoding'], entry['level']
+            else:
+                encoding, level = compression_policy(path, self.encoding,
+                                                     self.compression_level)
+                if checkpoint:
+                    entry = checkpoint.start(path, sha1, destination,
+                                             encoding, level)
+            metadata = {}
+            if encoding:
+                metadata['Content-Encoding'] = encoding
+            mimetype = content_type(path)
+            if mimetype:
+                metadata['Content-Type'] = mimetype
+
+            # Compress into memory, switching to a multipart upload as soon
+            # as the output outgrows a single part. Parts are uploaded by a
+            # thread pool while compression continues; at most two parts
+            # per thread are held in memory.
+            self._logger.debug('Uploading %s with Content-Encoding: %s' %
+                               (path, encoding))
+            mp = None
+            done_parts = {}
+            pool = None
+            in_flight = []
+            part_num = 0
+            buf = io.BytesIO()
+            on_part = None
+            if checkpoint:
+                on_part = lambda num, md5: checkpoint.add_part(path, num, md5)
+            try:
+                for chunk in content_chunks(path, encoding, level):
+                    buf.write(chunk)
+                    if buf.tell() >= self.PART_SIZE:
+                        if not mp:
+                            mp, done_parts = self._start_multipart(
+                                destination, metadata, checkpoint, path,
+                                entry)
+                            pool = ThreadPool(self.MULTIPART_THREADS)
+                        part_num += 1
+                        in_flight.append(pool.apply_async(
+                            self._upload_part,
+                            (mp, part_num, buf, done_parts.get(part_num),
+                             on_part)))
+                        if len(in_flight) >= 2 * self.MULTIPART_THREADS:
+                            in_flight.pop(0).get()
+                        buf = io.BytesIO()
+                if mp:
+                    if buf.tell():
+                        part_num += 1
+                        in_flight.append(pool.apply_async(
+                            self._upload_part,
+                            (mp, part_num, buf, done_parts.get(part_num),
+                             on_part)))
+                    for result in in_flight:
+                        result.get()
+                    mp.complete_upload()
+                else:
+                    for name, value in metadata.items():
+                        key.set_metadata(name, value)
+                    self._put(key, buf)
+            except Exception:
+                if mp and not checkpoint:
+                    mp.cancel_upload()
+                raise
+            finally:
+                if pool:
+                    pool.terminate()
 
             url = key.generate_url(expires_in=0,
                                    query_auth=False)
+            if checkpoint:
+                checkpoint.update(path, url=url, upload_id=None, parts={})
         except boto.exception.S3ResponseError, e:
             self._logger.exception(str(e))
             raise S3Error('%s' % e)
@@ -93,6 +586,201 @@ class S3Bucket(object):
         self._logger.debug('File %s uploaded to: %s' % (path, url))
         return url
 
+    def upload_dir(self, directory, prefix, skip_existing=True,
+                   threads=None):
+        """ Upload the files below `directory` to `prefix` followed by
+        their path relative to `directory`, `threads` files at a time.
+        Keys already present are not uploaded again unless `skip_existing`
+        is False. Return a dict mapping the relative paths to urls, and a
+        list of the relative paths of files which could not be uploaded.
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                relative = os.path.relpath(os.path.join(dirpath, filename),
+                                           directory)
+                paths.append('/'.join(relative.split(os.sep)))
+        existing = set()
+        if skip_existing:
+            existing = set(key.name for key in self.ls('.*', prefix))
+
+        def upload(relative):
+            name = prefix + relative
+            try:
+                if name in existing:
+                    self._logger.debug('Key %s exists; not uploading' % name)
+                    url = self.bucket.new_key(name).generate_url(
+                        expires_in=0, query_auth=False)
+                else:
+                    url = self.upload(os.path.join(directory,
+                                                   *relative.split('/')),
+                                      name, checkpoint_prefix=prefix)
+                return relative, url, None
+            except Exception, e:
+                return relative, None, e
+
+        manifest = {}
+        failed = []
+        pool = ThreadPool(threads or self.UPLOAD_DIR_THREADS)
+        try:
+            for relative, url, error in pool.imap_unordered(upload, paths):
+                if error:
+                    self._logger.error('Unable to upload %s: %s' %
+                                       (relative, error))
+                    failed.append(relative)
+                else:
+                    manifest[relative] = url
+        finally:
+            pool.close()
+            pool.join()
+        self._logger.info('%d files below %s stored, %d failed' %
+                          (len(manifest), directory, len(failed)))
+        return manifest, failed
+
+    def _checkpoint(self, prefix):
+        """ Return the UploadCheckpoint of the key prefix of `prefix`, e.g.
+        a job prefix or a key under it, or None if checkpoints are not
+        enabled.
+        """
+        if not self.checkpoint_dir:
+            return None
+        prefix = prefix.rsplit('/', 1)[0]
+        with self._checkpoints_lock:
+            checkpoint = self._checkpoints.get(prefix)
+            if not checkpoint:
+                if not os.path.isdir(self.checkpoint_dir):
+                    os.makedirs(self.checkpoint_dir)
+                elif not self._checkpoints:
+                    self._prune_checkpoints()
+                name = '%s.json' % hashlib.sha1(prefix).hexdigest()
+                checkpoint = UploadCheckpoint(
+                    os.path.join(self.checkpoint_dir, name), self._logger)
+                self._checkpoints[prefix] = checkpoint
+        return checkpoint
+
+    def _prune_checkpoints(self):
+        """ Delete the checkpoint files older than CHECKPOINT_MAX_AGE. """
+        cutoff = time.time() - self.CHECKPOINT_MAX_AGE
+        for name in os.listdir(self.checkpoint_dir):
+            path = os.path.join(self.checkpoint_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    self._logger.debug('Removed stale upload checkpoint %s' %
+                                       path)
+            except OSError, e:
+                self._logger.warning('Unable to remove upload checkpoint '
+                                     '%s: %s' % (path, e))
+
+    def _touch(self, key):
+        """ Refresh the last-modified time of existing `key` by copying
+        it onto itself, keeping its headers. Failures are only logged.
+        """
+        metadata = dict(key.metadata)
+        if key.content_type:
+            metadata['Content-Type'] = key.content_type
+        if key.content_encoding:
+            metadata['Content-Encoding'] = key.content_encoding
+        try:
+            key.copy(self.bucket_name, key.name, metadata=metadata,
+                     validate_dst_bucket=False)
+        except boto.exception.S3ResponseError, e:
+            self._logger.warning('Unable to refresh %s: %s' % (key.name, e))
+
+    def _start_multipart(self, destination, metadata, checkpoint, path,
+                         entry):
+        """ Return a multipart upload to `destination` and a dict mapping
+        the numbers of its parts already uploaded to their md5, resuming
+        the upload recorded in checkpoint `entry` if S3 still has it.
+        """
+        if entry and entry['upload_id']:
+            mp = MultiPartUpload(self.bucket)
+            mp.key_name = destination
+            mp.id = entry['upload_id']
+            try:
+                done_parts = dict((part.part_number, part.etag.strip('"'))
+                                  for part in mp)
+                self._logger.debug('Resuming multipart upload to %s after '
+                                   '%d parts' % (destination,
+                                                 len(done_parts)))
+                return mp, done_parts
+            except boto.exception.S3ResponseError, e:
+                self._logger.warning('Unable to resume multipart upload to '
+                                     '%s: %s' % (destination, e))
+        self._logger.debug('Starting multipart upload to: %s' % destination)
+        mp = self.bucket.initiate_multipart_upload(destination,
+                                                   metadata=metadata)
+        if checkpoint:
+            checkpoint.update(path, upload_id=mp.id, parts={})
+        return mp, {}
+
+    def _put(self, key, buf):
+        """ Set the contents of `key` from BytesIO `buf`. """
+        size = buf.tell()
+        buf.seek(0)
+        with self._throttled(size):
+            start = time.time()
+            try:
+                key.set_contents_from_file(buf)
+            except Exception:
+                self._record_put(start, size, failed=True)
+                raise
+        self._record_put(start, size)
+
+    @contextmanager
+    def _throttled(self, size):
+        """ Wait for the throttle, if any, to allow sending `size` bytes.
+        """
+        if not self.throttle:
+            yield
+            return
+        with self.throttle.transfer(size):
+            yield
+
+    def _upload_part(self, mp, part_num, buf, done_md5=None, on_part=None):
+        """ Upload BytesIO `buf` as part `part_num` of multipart upload
+        `mp`, retrying the part on failure, unless the part was already
+        uploaded with md5 `done_md5`. `on_part` is called with the part
+        number and md5 once uploaded. Runs in an upload thread.
+        """
+        md5 = hashlib.md5(buf.getvalue()).hexdigest()
+        if md5 == done_md5:
+            self._logger.debug('Part %d of %s already uploaded' %
+                               (part_num, mp.key_name))
+            return
+        part_mp = MultiPartUpload(self.bucket)
+        part_mp.key_name = mp.key_name
+        part_mp.id = mp.id
+        buf.seek(0, os.SEEK_END)
+        size = buf.tell()
+        for attempt in range(1, self.PART_ATTEMPTS + 1):
+            buf.seek(0)
+            start = time.time()
+            try:
+                with self._throttled(size):
+                    start = time.time()
+                    part_mp.upload_part_from_file(buf, part_num)
+                self._record_put(start, size)
+                if on_part:
+                    on_part(part_num, md5)
+                return
+            except Exception, e:
+                self._record_put(start, size, failed=True)
+                if attempt == self.PART_ATTEMPTS:
+                    raise
+                self._logger.warning('Attempt %d to upload part %d of %s '
+                                     'failed: %s' % (attempt, part_num,
+                                                     mp.key_name, e))
+                if self.metrics:
+                    self.metrics.retry(S3_PUT)
+                time.sleep(attempt)
+
+    def _record_put(self, start, size, failed=False):
+        if self.metrics:
+            self.metrics.record(S3_PUT, time.time() - start, size,
+                                failed=failed)
+
 if __name__ == '__main__':
     import ConfigParser
     import logging
@@ -111,6 +799,8 @@ if __name__ == '__main__':
     together either as command line options or in the --config file.
 
     --upload and --key must be specified together.
+
+    --upload-dir uploads a directory tree to keys starting with --key.
     """)
     parser.add_option('--s3-upload-bucket',
                       dest='s3_upload_bucket',
@@ -155,12 +845,55 @@ if __name__ == '__main__':
                       type='string',
                       default=None,
                       help='List matching keys in bucket.')
+    parser.add_option('--prefix',
+                      dest='prefix',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help="""Only list keys under this prefix.
+                      Defaults to the literal start of the --ls pattern.""")
+    parser.add_option('--delimiter',
+                      dest='delimiter',
+                      action='store',
+                      type='string',
+                      default='',
+                      help="""Group keys by this delimiter (e.g. /) and
+                      list the common prefixes instead of the keys below
+                      them.""")
     parser.add_option('--rm',
                       dest='rm',
                       action='store',
                       type='string',
                       default=None,
                       help='Delete matching keys in bucket.')
+    parser.add_option('--sweep-days',
+                      dest='sweep_days',
+                      action='store',
+                      type='int',
+                      default=None,
+                      help="""Delete builds whose build_id is more than
+                      this many days old.""")
+    parser.add_option('--sweep-prefix',
+                      dest='sweep_prefix',
+                      action='store',
+                      type='string',
+                      default='',
+                      help="""Only sweep builds under this prefix, e.g.
+                      mozilla-central/ or mozilla-central/Nightly/.""")
+    parser.add_option('--dry-run',
+                      dest='dry_run',
+                      action='store_true',
+                      default=False,
+                      help="""With --sweep-days, only report the builds
+                      which would be deleted.""")
+    parser.add_option('--sweep-blobs',
+                      dest='sweep_blobs',
+                      action='store_true',
+                      default=False,
+                      help="""With --sweep-days, also delete content
+                      addressed blobs (blobs/) not uploaded or reused
+                      within that many days. Without it blobs are kept
+                      forever.""")
     parser.add_option('--upload',
                       dest='upload',
                       action='store',
@@ -174,9 +907,27 @@ if __name__ == '__main__':
                       action='store',
                       type='string',
                       default=None,
-                      help="""Bucket key for uploaded file.
+                      help="""Bucket key for uploaded file, or key
+                      prefix of the files uploaded with --upload-dir.
                       If --upload is specified, --key must also
                       be specified.""")
+    parser.add_option('--upload-dir',
+                      dest='upload_dir',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help="""Directory whose files are uploaded
+                      recursively to keys starting with --key, e.g.
+                      mozilla-central/Nightly/, which must be specified and
+                      is taken as a directory. Keys already present are
+                      skipped. Prints a json manifest of the urls.""")
+    parser.add_option('--workers',
+                      dest='workers',
+                      action='store',
+                      type='int',
+                      default=S3Bucket.UPLOAD_DIR_THREADS,
+                      help="""Number of files --upload-dir uploads at a
+                      time.""")
 
     (cmd_options, args) = parser.parse_args()
 
@@ -197,8 +948,19 @@ if __name__ == '__main__':
         parser.print_usage()
         sys.exit(1)
 
+    if cmd_options.upload and cmd_options.upload_dir:
+        parser.error('--upload and --upload-dir are mutually exclusive.')
+        parser.print_usage()
+        sys.exit(1)
+
+    if cmd_options.upload_dir and not cmd_options.key:
+        parser.error('--upload-dir and --key must be specified together.')
+        parser.print_usage()
+        sys.exit(1)
+
     if ((cmd_options.upload or cmd_options.key) and (
-            not cmd_options.upload or not cmd_options.key)):
+            not cmd_options.upload or not cmd_options.key) and
+            not cmd_options.upload_dir):
         parser.error('--upload and --key must be specified together.')
         parser.print_usage()
         sys.exit(1)
@@ -209,7 +971,9 @@ if __name__ == '__main__':
         not cmd_options.config and
         not cmd_options.ls and
         not cmd_options.rm and
+        not cmd_options.sweep_days and
         not cmd_options.upload and
+        not cmd_options.upload_dir and
         not cmd_options.key):
         parser.print_usage()
         sys.exit(1)
@@ -223,8 +987,44 @@ if __name__ == '__main__':
 
     if cmd_options.upload:
         print s3bucket.upload(cmd_options.upload, cmd_options.key)
+    if cmd_options.upload_dir:
+        prefix = cmd_options.key
+        if not prefix.endswith('/'):
+            prefix += '/'
+        manifest, failed = s3bucket.upload_dir(cmd_options.upload_dir,
+                                               prefix,
+                                               threads=cmd_options.workers)
+        print json.dumps(manifest, indent=4, separators=(',', ': '),
+                         sort_keys=True)
+        if failed:
+            sys.exit(1)
     if cmd_options.ls:
-        for key in s3bucket.ls(cmd_options.ls):
+        for key in s3bucket.ls(cmd_options.ls, cmd_options.prefix,
+                               cmd_options.delimiter):
             print key.name
     if cmd_options.rm:
         s3bucket.rm(cmd_options.rm)
+    if cmd_options.sweep_days is not None:
+        cutoff = datetime.now() - timedelta(days=cmd_options.sweep_days)
+        builds = s3bucket.sweep(cutoff, cmd_options.sweep_prefix,
+                                dry_run=cmd_options.dry_run)
+        for build in builds:
+            print '%s %d keys %d bytes%s' % (
+                build['prefix'], build['keys'], build['bytes'],
+                ' (%d not deleted)' % len(build['failed'])
+                if build['failed'] else '')
+        print '%s %d builds, %d keys, %d bytes' % (
+            'Would delete' if cmd_options.dry_run else 'Deleted',
+            len(builds), sum(build['keys'] for build in builds),
+            sum(build['bytes'] for build in builds))
+        failed = any(build['failed'] for build in builds)
+        if cmd_options.sweep_blobs:
+            blobs = s3bucket.sweep_blobs(cutoff, dry_run=cmd_options.dry_run)
+            print '%s %d blobs, %d bytes%s' % (
+                'Would delete' if cmd_options.dry_run else 'Deleted',
+                blobs['keys'], blobs['bytes'],
+                ' (%d not deleted)' % len(blobs['failed'])
+                if blobs['failed'] else '')
+            failed = failed or blobs['failed']
+        if failed:
+            sys.exit(1)
@@ -0,0 +1,531 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Storage backends for uploaded job artifacts"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import json
+import os
+import re
+import shutil
+import sre_constants
+import sre_parse
+import tempfile
+import threading
+import time
+import urllib
+
+from metrics import LOCAL_PUT
+
+# A stored object, or with a delimiter a common prefix (size None), as
+# returned by LocalStorage.ls.
+LocalKey = namedtuple('LocalKey', ['name', 'size'])
+
+# Directory where UploadThrottle keeps the state shared by the processes
+# uploading from a node, and where tests mark themselves active.
+DEFAULT_THROTTLE_DIR = os.path.join(tempfile.gettempdir(),
+                                    'mozplatformqa-uploads')
+
+
+def replace_file(source, target):
+    """ Rename `source` to `target`, replacing any existing `target`. """
+    if os.name == 'nt' and os.path.exists(target):
+        # rename does not replace an existing file on Windows
+        os.remove(target)
+    os.rename(source, target)
+
+
+def write_json(path, data, **kwargs):
+    """ Write `data` as json to `path` through a temporary file, so that
+    readers (and a crash) never leave a partially written file behind.
+    Keyword arguments are passed to json.dump. Raises IOError or OSError.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **kwargs)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp, 0644)
+        replace_file(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def literal_prefix(pattern):
+    """ Return the literal text every string matched by regular expression
+    `pattern` (with re.match) starts with, e.g. 'mozilla-central/Nightly/'
+    for r'^mozilla-central/Nightly/.*\.log$'. Returns '' when no such prefix
+    can be determined.
+    """
+    if isinstance(pattern, basestring):
+        flags = 0
+    else:
+        pattern, flags = pattern.pattern, pattern.flags
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except sre_constants.error:
+        return ''
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return ''
+    char = unichr if isinstance(pattern, unicode) else chr
+    return _parsed_prefix(parsed, char)[0]
+
+
+def _parsed_prefix(items, char):
+    """ Return the literal text the sre_parse `items` start with, and
+    whether they are nothing but that text. `char` turns a code into a
+    character: chr or unichr.
+    """
+    prefix = []
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            prefix.append(char(av))
+        elif (op == sre_constants.AT and
+              av in (sre_constants.AT_BEGINNING,
+                     sre_constants.AT_BEGINNING_STRING)):
+            continue
+        elif op == sre_constants.SUBPATTERN:
+            text, complete = _parsed_prefix(av[-1], char)
+            prefix.append(text)
+            if not complete:
+                return ''.join(prefix), False
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+              and av[0] >= 1):
+            # the repeated item occurs at least once
+            prefix.append(_parsed_prefix(av[2], char)[0])
+            return ''.join(prefix), False
+        else:
+            # alternation, character classes, optional items etc.
+            return ''.join(prefix), False
+    return ''.join(prefix), True
+
+
+class StorageError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, 'StorageError: %s' % message)
+
+
+class StorageBackend(object):
+    """ Interface of the stores artifacts are uploaded to, implemented by
+    s3.S3Bucket and LocalStorage. Failures raise StorageError.
+    """
+    # optional metrics.SubmissionMetrics recording each upload
+    metrics = None
+
+    def upload(self, path, destination, overwrite=True,
+               checkpoint_prefix=None):
+        """ Store `path` under key `destination` and return its url. If
+        `overwrite` is False and the key already exists, the existing object
+        is kept and its url returned. Backends which resume uploads keep
+        one checkpoint per `checkpoint_prefix`, e.g. a job's key prefix;
+        it defaults to the key prefix of `destination`.
+        """
+        raise NotImplementedError
+
+    def ls(self, keypattern='.*', prefix=None, delimiter=''):
+        """ Iterate over the keys under `prefix` matching `keypattern`.
+        Each has a `name`. With a `delimiter`, common prefixes are returned
+        instead of the keys below them.
+        """
+        raise NotImplementedError
+
+    def rm(self, keys):
+        """ Delete `keys`, an iterable of keys or key names, or the keys
+        matching a pattern string.
+        """
+        raise NotImplementedError
+
+
+class LocalStorage(StorageBackend):
+    """ Stores artifacts as plain files under directory `root`. Urls are
+    file:// urls unless `base_url`, e.g. the url of a web server serving
+    `root`, is given.
+    """
+    def __init__(self, root, logger, base_url=None, metrics=None):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self._logger = logger
+        self.metrics = metrics
+
+    def _path(self, name):
+        path = os.path.normpath(os.path.join(self.root, *name.split('/')))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError('key %s is outside of %s' % (name, self.root))
+        return path
+
+    def url(self, name):
+        if self.base_url:
+            return '%s/%s' % (self.base_url, urllib.quote(name))
+        return 'file://' + urllib.pathname2url(self._path(name))
+
+    def upload(self, path, destination, overwrite=True,
+               checkpoint_prefix=None):
+        target = self._path(destination)
+        if not overwrite and os.path.exists(target):
+            self._logger.debug('Key %s exists; not uploading %s' %
+                               (destination, path))
+            return self.url(destination)
+        start = time.time()
+        try:
+            target_dir = os.path.dirname(target)
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            # copy to a temporary file first so readers never see a
+            # partially written key
+            fd, tmp = tempfile.mkstemp(dir=target_dir)
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                # mkstemp creates the file readable by its owner only
+                os.chmod(tmp, 0644)
+                replace_file(tmp, target)
+            except:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError), e:
+            self._record_put(start, 0, failed=True)
+            self._logger.exception(str(e))
+            raise StorageError('%s' % e)
+        self._record_put(start, os.path.getsize(target))
+        url = self.url(destination)
+        self._logger.debug('File %s uploaded to: %s' % (path, url))
+        return url
+
+    def _record_put(self, start, size, failed=False):
+        if self.metrics:
+            self.metrics.record(LOCAL_PUT, time.time() - start, size,
+                                failed=failed)
+
+    def _names(self, prefix):
+        """ Yield the names of the keys under `prefix` in sorted order. """
+        # only walk the deepest directory containing the prefix
+        top = self.root
+        if '/' in prefix:
+            top = self._path(prefix.rsplit('/', 1)[0])
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, self.root)
+            for filename in sorted(filenames):
+                if relative == os.curdir:
+                    name = filename
+                else:
+                    name = '/'.join(relative.split(os.sep) + [filename])
+                if name.startswith(prefix):
+                    yield name
+
+    def ls(self, keypattern='.*', prefix=None, delimiter=''):
+        if isinstance(keypattern, basestring):
+            keypattern = re.compile(keypattern)
+        if prefix is None:
+            prefix = literal_prefix(keypattern)
+        common_prefixes = set()
+        for name in self._names(prefix):
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if common in common_prefixes:
+                    continue
+                common_prefixes.add(common)
+                key = LocalKey(common, None)
+            else:
+                key = LocalKey(name, os.path.getsize(self._path(name)))
+            if keypattern.match(key.name):
+                yield key
+
+    def rm(self, keys):
+        if isinstance(keys, basestring):
+            keys = self.ls(keys)
+        failed = []
+        for key in keys:
+            name = key if isinstance(key, basestring) else key.name
+            path = self._path(name)
+            try:
+                os.remove(path)
+            except OSError, e:
+                self._logger.warning('Unable to delete %s: %s' % (name, e))
+                failed.append(name)
+                continue
+            # remove directories left empty
+            parent = os.path.dirname(path)
+            while parent != self.root:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        if failed:
+            raise StorageError('unable to delete %d keys: %s%s' %
+                               (len(failed), ', '.join(failed[:10]),
+                                ', ...' if len(failed) > 10 else ''))
+
+
+class FileLock(object):
+    """ Lock shared between processes, held by exclusively creating the
+    file at `path`. A lock older than `stale_after` seconds is assumed to
+    have been left behind by a killed process and is broken.
+    """
+    def __init__(self, path, stale_after=60):
+        self.path = path
+        self.stale_after = stale_after
+
+    def acquire(self, blocking=True):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()))
+                os.close(fd)
+                return True
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.path.getmtime(self.path) > \
+                        self.stale_after:
+                    os.remove(self.path)
+                    continue
+            except OSError:
+                # released meanwhile
+                continue
+            if not blocking:
+                return False
+            time.sleep(0.05)
+
+    def refresh(self):
+        """ Mark a held lock as alive, so that it is not broken as stale.
+        """
+        try:
+            os.utime(self.path, None)
+        except OSError:
+            pass
+
+    def release(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+@contextmanager
+def test_active(state_dir=DEFAULT_THROTTLE_DIR, logger=None):
+    """ Mark a test as running on this node for the duration of the
+    block, so that UploadThrottles sharing `state_dir` slow down or defer
+    uploads. Nothing is marked if `state_dir` is None. Failing to mark
+    the test is logged and never keeps the block from running.
+    """
+    marker = None
+    if state_dir:
+        try:
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            fd, marker = tempfile.mkstemp(prefix='active-', dir=state_dir)
+            os.close(fd)
+        except (IOError, OSError):
+            if logger:
+                logger.exception('Unable to mark test active in %s' %
+                                 state_dir)
+    try:
+        yield
+    finally:
+        if marker:
+            try:
+                os.remove(marker)
+            except OSError:
+                if logger:
+                    logger.exception('Unable to remove test marker %s' %
+                                     marker)
+
+
+class UploadThrottle(object):
+    """ Limits the bandwidth and the number of concurrent transfers of all
+    processes on a node which share `state_dir`, so that uploads do not
+    disturb tests measuring network performance.
+
+    rate - bytes per second when no test is active, 0 for no limit
+    max_concurrent - transfers at a time, 0 for no limit
+    active_rate - bytes per second while a test is active (see
+                  test_active); 0 defers transfers until no test is active
+                  or for at most `max_defer` seconds; None for `rate`
+    burst - bytes which may be sent at once after an idle period;
+            defaults to one second at the current rate
+
+    Bandwidth is shared through a token bucket kept in a json file and
+    concurrency through slot lock files.
+    """
+    # test markers older than this are left over from killed runs
+    ACTIVE_MAX_AGE = 6 * 60 * 60
+    # a slot not refreshed for this long was left by a killed transfer;
+    # held slots are refreshed every SLOT_STALE_AFTER / 4 seconds
+    SLOT_STALE_AFTER = 10 * 60
+    POLL_INTERVAL = 5
+
+    def __init__(self, state_dir=DEFAULT_THROTTLE_DIR, rate=0,
+                 max_concurrent=0, active_rate=None, burst=None,
+                 max_defer=60 * 60, logger=None):
+        self.state_dir = state_dir
+        self.rate = rate
+        self.max_concurrent = max_concurrent
+        self.active_rate = active_rate
+        self.burst = burst
+        self.max_defer = max_defer
+        self._logger = logger
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+    def test_active(self):
+        """ Return True if a test is marked active on this node. """
+        now = time.time()
+        for name in os.listdir(self.state_dir):
+            if not name.startswith('active-'):
+                continue
+            try:
+                mtime = os.path.getmtime(os.path.join(self.state_dir, name))
+            except OSError:
+                continue
+            if now - mtime < self.ACTIVE_MAX_AGE:
+                return True
+        return False
+
+    def _current_rate(self):
+        """ Return the rate transfers may use now, waiting while uploads
+        are deferred.
+        """
+        if self.active_rate is None:
+            return self.rate
+        deferred = 0
+        while self.test_active():
+            if self.active_rate:
+                return self.active_rate
+            if deferred >= self.max_defer:
+                if self._logger:
+                    self._logger.warning('Uploads deferred for %ds; '
+                                         'resuming while a test is active' %
+                                         deferred)
+                break
+            time.sleep(self.POLL_INTERVAL)
+            deferred += self.POLL_INTERVAL
+        return self.rate
+
+    def _acquire_slot(self):
+        if not self.max_concurrent:
+            return None
+        while True:
+            for i in range(self.max_concurrent):
+                slot = FileLock(os.path.join(self.state_dir,
+                                             'slot-%d.lock' % i),
+                                self.SLOT_STALE_AFTER)
+                if slot.acquire(blocking=False):
+                    return slot
+            time.sleep(0.1)
+
+    def _keep_slot(self, slot, done):
+        """ Refresh `slot` until event `done` is set, however long the
+        transfer takes. Runs in a thread.
+        """
+        while not done.wait(self.SLOT_STALE_AFTER / 4.0):
+            slot.refresh()
+
+    def _take_tokens(self, size, rate):
+        """ Take `size` bytes from the shared token bucket filling at
+        `rate`, sleeping for as long as the bucket is in debt.
+        """
+        burst = self.burst or rate
+        state_path = os.path.join(self.state_dir, 'tokens.json')
+        with FileLock(state_path + '.lock', stale_after=10):
+            now = time.time()
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                tokens = min(burst, state['tokens'] +
+                             (now - state['updated']) * rate)
+            except (IOError, ValueError, KeyError):
+                tokens = burst
+            tokens -= size
+            with open(state_path, 'w') as f:
+                json.dump({'tokens': tokens, 'updated': now}, f)
+        if tokens < 0:
+            time.sleep(-tokens / float(rate))
+
+    @contextmanager
+    def transfer(self, size):
+        """ Wait until `size` bytes may be sent, and hold a transfer slot
+        for the duration of the block.
+        """
+        rate = self._current_rate()
+        slot = self._acquire_slot()
+        done = threading.Event()
+        if slot:
+            keeper = threading.Thread(target=self._keep_slot,
+                                      args=(slot, done))
+            keeper.daemon = True
+            keeper.start()
+        try:
+            if rate:
+                self._take_tokens(size, rate)
+            yield
+        finally:
+            if slot:
+                done.set()
+                keeper.join()
+                slot.release()
+
+
+def open_storage(config, logger):
+    """ Return the storage backend described by dict `config`, the contents
+    of the s3 credentials json file. Its "backend" selects:
+
+    - "s3" (default): s3_bucket_name, aws_access_key_id, aws_access_key
+      and optionally
+        s3_endpoint - url of an S3-compatible server to use instead of AWS
+        content_encoding - "gzip" or "br"
+        compression_level - gzip level or brotli quality used for all
+                            files instead of the size based default;
+                            0 stores files uncompressed
+        checkpoint_dir - directory of upload checkpoints letting retried
+                         jobs resume uploads; pruned after a week
+        throttle - dict of UploadThrottle settings: dir, rate,
+                   max_concurrent, active_rate, burst and max_defer
+    - "local": storage_path and optionally storage_url, the url the
+      directory is served at
+    """
+    backend = config.get('backend', 's3')
+    if backend == 's3':
+        from s3 import S3Bucket
+        throttle = None
+        if config.get('throttle'):
+            t = config['throttle']
+            throttle = UploadThrottle(t.get('dir', DEFAULT_THROTTLE_DIR),
+                                      rate=t.get('rate', 0),
+                                      max_concurrent=t.get('max_concurrent',
+                                                           0),
+                                      active_rate=t.get('active_rate'),
+                                      burst=t.get('burst'),
+                                      max_defer=t.get('max_defer', 60 * 60),
+                                      logger=logger)
+        return S3Bucket(config['s3_bucket_name'],
+                        config['aws_access_key_id'],
+                        config['aws_access_key'],
+                        logger,
+                        encoding=config.get('content_encoding', 'gzip'),
+                        compression_level=config.get('compression_level'),
+                        checkpoint_dir=config.get('checkpoint_dir'),
+                        throttle=throttle,
+                        endpoint=config.get('s3_endpoint'))
+    if backend == 'local':
+        return LocalStorage(config['storage_path'],
+                            logger,
+                            config.get('storage_url'))
+    raise StorageError('unknown storage backend %s' % backend)
@@ -5,24 +5,33 @@
 # Based on https://github.com/mozilla/autophone/blob/master/autophonetreeherder.py
 
 import datetime
+import fnmatch
 import glob
+import hashlib
 import logging
+import mimetypes
 from platform import node
 import os
 import re
+import shutil
+import tempfile
 import time
 import traceback
 import urlparse
 import requests
 import uuid
+import weakref
 import json
+import multiprocessing
 
 import mozinfo
 import mozversion
 from thclient import TreeherderClient, TreeherderJobCollection
 
+from metrics import (SubmissionMetrics, RESULTSET_LOOKUP, JOBS_LOOKUP,
+                     COLLECTION_POST)
 from parsers import parse_log
-from s3 import S3Error
+from storage import StorageError, write_json
 
 logger = logging.getLogger()
 
@@ -39,108 +48,65 @@ releases = {'mozilla-central': 'Nightly',
             'mozilla-esr38': 'ESR38'}
 
 # Based on https://github.com/mozilla/treeherder/blob/master/treeherder/etl/buildbot.py; adapted to work with mozinfo
-platforms = [
-    {
-        'regex': re.compile(r'(mac|OS X).*(10\.10|yosemite).*(64)?',
-                            re.IGNORECASE),
-        'attributes': {
-            'os_name': 'mac',
-            'platform': 'osx-10-10',
-            'architecture': 'x86_64',
-        }
-    },
-    {
-        'regex': re.compile(r'(mac|OS X).*(10\.9|mavericks).*(64)?',
-                            re.IGNORECASE),
-        'attributes': {
-            'os_name': 'mac',
-            'platform': 'osx-10-9',
-            'architecture': 'x86_64',
-        }
-    },
-    {
-        'regex': re.compile(r'(mac|OS X).*(10\.8|mountain lion).*(64)?',
-                            re.IGNORECASE),
-        'attributes': {
-            'os_name': 'mac',
-            'platform': 'osx-10-8',
-            'architecture': 'x86_64',
-        }
-    },
-    {
-        'regex': re.compile(r'(mac|OS X).*(10\.7|lion).*(64)?', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'mac',
-            'platform': 'osx-10-7',
-            'architecture': 'x86_64',
-        }
-    },
-    {
-        'regex': re.compile(r'(mac|OS X).*(10\.6|snow[ ]?leopard).*(64)?',
-                            re.IGNORECASE),
-        'attributes': {
-            'os_name': 'mac',
-            'platform': 'osx-10-6',
-            'architecture': 'x86_64',
-        }
-    },  # ** Windows
-    {
-        'regex': re.compile(r'win(dows)?.*(5|5\.1|xp).*32', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'win',
-            'platform': 'windowsxp',
-            'architecture': 'x86',
-        }
-    },
-    {
-        'regex': re.compile(r'win(dows)?.*(6\.2|8).*64', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'win',
-            'platform': 'windows8-64',
-            'architecture': 'x86_64',
-        }
-    },
-    {
-        'regex': re.compile(r'win(dows)?.*(6\.2|8).*32', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'win',
-            'platform': 'windows8-32',
-            'architecture': 'x86',
-        }
-    },
-    {
-        'regex': re.compile(r'win(dows)?.*(6\.1|7).*32', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'win',
-            'platform': 'windows7-32',
-            'architecture': 'x86',
-        }
-    },
-    {
-        'regex': re.compile(r'win(dows)?.*(6\.1|7).*64', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'win',
-            'platform': 'windows7-64',
-            'architecture': 'x86_64',
-        }
-    },  # ** Linux **
-    {
-        'regex': re.compile(r'(linux|ubuntu).*64', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'linux',
-            'platform': 'linux64',
-            'architecture': 'x86_64',
-        }
-    },
-    {
-        'regex': re.compile(r'(linux|ubuntu).*32', re.IGNORECASE),
-        'attributes': {
-            'os_name': 'linux',
-            'platform': 'linux32',
-            'architecture': 'x86',
-        }
-    }
-]
+# Patterns are tried in order; the first one that matches wins.
+PLATFORMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'platforms.json')
+
+
+def load_platforms(path=PLATFORMS_PATH):
+    """ Load the platform table: a list of dicts with a case-insensitive
+    'regex' and the Treeherder 'attributes' it maps to.
+    """
+    with open(path) as f:
+        table = json.load(f)
+    return [{'regex': re.compile(entry['pattern'], re.IGNORECASE),
+             'attributes': dict((str(k), str(v)) for k, v in
+                                entry['attributes'].items())}
+            for entry in table]
+
+
+def _uncapture(pattern):
+    """ Turn capturing groups in `pattern` into non-capturing ones so it can
+    be embedded in a larger expression without adding groups.
+    """
+    out = []
+    escaped = in_class = False
+    for i, c in enumerate(pattern):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '(' and not pattern.startswith('?', i + 1):
+            out.append('(?:')
+            continue
+        out.append(c)
+    return ''.join(out)
+
+
+def compile_platform_matcher(table):
+    """ Combine the patterns of `table` into a single expression with one
+    named group per entry, so one match attempt finds the first matching
+    entry.
+    """
+    return re.compile('|'.join('(?P<p%d>%s)' % (i, _uncapture(d['regex'].pattern))
+                               for i, d in enumerate(table)),
+                      re.IGNORECASE)
+
+
+platforms = load_platforms()
+_platform_matcher = compile_platform_matcher(platforms)
+# pf string -> attributes (or None)
+_platform_cache = {}
+
+# mozversion results shared by all jobs on this node
+VERSION_CACHE_PATH = (os.environ.get('MOZVERSION_CACHE') or
+                      os.path.join(tempfile.gettempdir(),
+                                   'mozplatformqa-version-cache.json'))
+_machine_info = {}
 
 
 def timestamp_now():
@@ -151,12 +117,66 @@ def get_platform_attributes(pf):
     """ Map a string like "Win 7 32-bit" to platform attributes recognized by
     Treeherder
     """
+    if pf in _platform_cache:
+        return _platform_cache[pf]
     logger.debug('get_platform_attributes - pf: %s', pf)
-    for d in platforms:
-        if d['regex'].match(pf):
-            logger.debug('get_platform_attributes - matched pattern: %s',
-                         d['regex'].pattern)
-            return d['attributes']
+    attributes = None
+    match = _platform_matcher.match(pf)
+    if match:
+        d = platforms[int(match.lastgroup[1:])]
+        logger.debug('get_platform_attributes - matched pattern: %s',
+                     d['regex'].pattern)
+        attributes = d['attributes']
+    _platform_cache[pf] = attributes
+    return attributes
+
+
+def _read_version_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_version_cache(path, cache):
+    try:
+        write_json(path, cache)
+    except (IOError, OSError):
+        logger.warning('Unable to write version cache %s' % path,
+                       exc_info=True)
+
+
+def get_version_info(binary, cache_path=VERSION_CACHE_PATH):
+    """ Return mozversion info for `binary`. Results are cached on disk,
+    keyed by binary path, mtime and size, so repeated jobs against the same
+    installed build skip reading application.ini/platform.ini.
+    """
+    binary = os.path.abspath(binary)
+    st = os.stat(binary)
+    key = '%s|%d|%d' % (binary, int(st.st_mtime), st.st_size)
+    cache = _read_version_cache(cache_path)
+    if key in cache:
+        logger.debug('get_version_info - cache hit: %s' % key)
+        return cache[key]
+    version = mozversion.get_version(binary=binary)
+    # Re-read in case another job on this node updated the cache meanwhile,
+    # and drop entries for older builds installed at the same path.
+    cache = _read_version_cache(cache_path)
+    for k in cache.keys():
+        if k.rsplit('|', 2)[0] == binary:
+            del cache[k]
+    cache[key] = version
+    _write_version_cache(cache_path, cache)
+    return version
+
+
+def get_machine_info():
+    """ Return the subset of mozinfo.info used for job info. """
+    if not _machine_info:
+        for k in ('os', 'version', 'bits', 'processor'):
+            _machine_info[k] = mozinfo.info[k]
+    return _machine_info
 
 
 def collect_job_info(job, binary='', installer=''):
@@ -170,8 +190,8 @@ def collect_job_info(job, binary='', installer=''):
     """
     if not binary:
         raise ValueError('Missing argument: binary.')
-    build = mozversion.get_version(binary=binary)
-    machine = mozinfo.info
+    build = get_version_info(binary)
+    machine = get_machine_info()
     machine_string = build_string = ' '.join([machine['os'],
                                               machine['version'],
                                               str(machine['bits'])])
@@ -213,14 +233,53 @@ def collect_job_info(job, binary='', installer=''):
     job.build['build_id'] = build['application_buildid']
 
 
-def upload_file(s3_bucket, key_prefix, filepath, logger, job=None):
+def content_key(filepath):
+    """ Return a content-addressed S3 key for `filepath`: files with the
+    same contents share a key regardless of job or run.
+    """
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    filename = os.path.basename(filepath).replace(' ', '-')
+    return 'blobs/%s/%s/%s' % (digest[:2], digest, filename)
+
+
+def upload_file(s3_bucket, key_prefix, filepath, logger, job=None,
+                journal=None, content_addressed=False, journal_key=None):
+    """ Upload `filepath` and add a link to it to the job details of `job`.
+    If `content_addressed` is True the file is stored under content_key()
+    instead of `key_prefix`, and not uploaded again if already stored.
+    :param journal_key: path the upload is recorded under in `journal`,
+                        e.g. the original of a truncated copy; defaults to
+                        `filepath`
+    """
+    journal_key = journal_key or filepath
     filename = os.path.basename(filepath)
     # add timestamp in case filename not unique
     name = str(timestamp_now()) + filename
     s3_key = (key_prefix + name).replace(' ', '-')
     try:
-        upload_url = s3_bucket.upload(filepath, s3_key)
-        logger.info('Artifact uploaded to %s' % upload_url)
+        upload_url = None
+        if journal and job:
+            upload_url = journal.get_upload(job.job_guid, journal_key)
+        if upload_url:
+            logger.info('Artifact already uploaded to %s' % upload_url)
+        else:
+            # one upload checkpoint per job, also for blobs stored
+            # outside the job's prefix
+            if content_addressed:
+                upload_url = s3_bucket.upload(filepath,
+                                              content_key(filepath),
+                                              overwrite=False,
+                                              checkpoint_prefix=key_prefix)
+            else:
+                upload_url = s3_bucket.upload(filepath, s3_key,
+                                              checkpoint_prefix=key_prefix)
+            logger.info('Artifact uploaded to %s' % upload_url)
+            if journal and job:
+                journal.add_upload(job.job_guid, journal_key, upload_url)
         if job:
             job.job_details.append({
                 'url': upload_url,
@@ -228,7 +287,7 @@ def upload_file(s3_bucket, key_prefix, filepath, logger, job=None):
                 'content_type': 'link',
                 'title': 'artifact uploaded'})
         return upload_url
-    except (S3Error, IOError):
+    except (StorageError, IOError):
         message = 'Failed to upload %s.' % filename
         if job:
             job.job_details.append({
@@ -238,11 +297,126 @@ def upload_file(s3_bucket, key_prefix, filepath, logger, job=None):
         logger.exception('\n'.join([message, traceback.format_exc()]))
 
 
-def get_from_treeherder(url, logger):
+def plan_uploads(job):
+    """ Return the files to upload for `job` as a list of (path, shared)
+    tuples, most important first: error logs, parsed logs, other logs,
+    config files, then the upload_dir files matching upload_dir_include
+    and not upload_dir_exclude.
+    """
+    def priority(path):
+        if 'error' in os.path.basename(path).lower():
+            return 0
+        if path in job.parsed_logs:
+            return 1
+        return 2
+    logs = ([(path, True) for path in job.shared_files] +
+            [(path, False) for path in job.log_files])
+    # sorted() is stable, so files of equal priority keep their order
+    plan = sorted(logs, key=lambda item: priority(item[0]))
+    plan += [(path, False) for path in job.config_files]
+    if job.upload_dir:
+        for f in sorted(glob.glob(os.path.join(job.upload_dir, '*'))):
+            name = os.path.basename(f)
+            if (any(fnmatch.fnmatch(name, p) for p in job.upload_dir_include)
+                    and not any(fnmatch.fnmatch(name, p)
+                                for p in job.upload_dir_exclude)):
+                plan.append((f, False))
+    unique = []
+    for path, shared in plan:
+        if path not in [p for p, _ in unique]:
+            unique.append((path, shared))
+    return unique
+
+
+# Files that can be truncated for upload; anything else is skipped when it
+# exceeds the upload caps, since a truncated binary is useless
+TEXT_EXTENSIONS = ('.log', '.txt', '.ini', '.cfg', '.json', '.xml', '.html')
+
+
+def is_text_file(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in TEXT_EXTENSIONS:
+        return True
+    mimetype = mimetypes.guess_type(path, False)[0]
+    return bool(mimetype) and mimetype.startswith('text/')
+
+
+def truncate_file(path, max_size, dest_dir):
+    """ Copy the head and tail of `path` into `dest_dir` so the copy is at
+    most `max_size` bytes, with a marker line where data was left out.
+    Returns the path of the copy, which has the same file name.
+    """
+    size = os.path.getsize(path)
+    marker = ('\n[... %d bytes truncated by mozplatformqa-jenkins; '
+              'original size %d bytes ...]\n')
+    keep = max(max_size - len(marker % (size, size)), 0)
+    head = keep // 2
+    tail = keep - head
+    copy_path = os.path.join(dest_dir, os.path.basename(path))
+    with open(path, 'rb') as src:
+        with open(copy_path, 'wb') as dst:
+            dst.write(src.read(head))
+            dst.write(marker % (size - head - tail, size))
+            if tail:
+                src.seek(-tail, os.SEEK_END)
+                dst.write(src.read(tail))
+    return copy_path
+
+
+def offload_artifact(s3_bucket, key_prefix, artifact, logger, job=None):
+    """ Upload an artifact blob to S3 and return a small reference artifact
+    to submit in its place, or None if the upload failed.
+    :param artifact: tuple of name, type, blob as in TestJob.artifacts
+    """
+    name, artifact_type, blob = artifact
+    if not isinstance(blob, basestring):
+        blob = json.dumps(blob)
+    if isinstance(blob, unicode):
+        blob = blob.encode('utf-8')
+    filename = re.sub(r'[^\w.-]', '-', name) + '.' + artifact_type
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(tmpdir, filename)
+        with open(filepath, 'wb') as f:
+            f.write(blob)
+        url = upload_file(s3_bucket, key_prefix, filepath, logger, job)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if not url:
+        return None
+    reference = {'offloaded': True,
+                 'url': url,
+                 'type': artifact_type,
+                 'size': len(blob)}
+    return (name, 'json', reference)
+
+
+def _parse_log_worker(log_file):
+    """ Build the text_log_summary artifact of `log_file` in a pool worker;
+    the log url is filled in once the upload is done.
+    """
+    return parse_log(log_file, None, logger)
+
+
+def get_from_treeherder(url, logger, metrics=None, endpoint=None,
+                        timeout=None):
     """ Retrieves json results of a GET request to Treeherder's API
     :param url: url of API endpoint
+    :param metrics: optional SubmissionMetrics to record the request in
+    :param endpoint: endpoint name for metrics
+    :param timeout: optional request timeout in seconds
     """
-    api_lookup = requests.get(url, headers=DEFAULT_REQUEST_HEADERS)
+    start = time.time()
+    try:
+        api_lookup = requests.get(url, headers=DEFAULT_REQUEST_HEADERS,
+                                  timeout=timeout)
+    except Exception:
+        if metrics:
+            metrics.record(endpoint, time.time() - start, failed=True)
+        raise
+    if metrics:
+        metrics.record(endpoint, time.time() - start,
+                       failed=not api_lookup.ok)
     message = 'GET: %s' % url
     logger.debug('get_from_treeherder - ' + message)
 
@@ -269,6 +443,81 @@ class JobState(object):
     COMPLETED = 'completed'
     PENDING = 'pending'
     RUNNING = 'running'
+    # order in which a job moves through the states
+    ORDER = (PENDING, RUNNING, COMPLETED)
+
+
+def stable_job_guid(*parts):
+    """ Return a job_guid derived from `parts`, e.g. a Jenkins build tag
+    and the job's position within the build, so that a re-run of the same
+    build submits the same guid and its SubmissionJournal entries match.
+    """
+    name = '/'.join(str(part) for part in parts)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+class SubmissionJournal(object):
+    """ Local record of the states posted and the files uploaded for each
+    job_guid, so that a resumed or repeated submission only sends what is
+    missing. Jobs need a guid that survives the re-run for this to work;
+    see stable_job_guid.
+
+    The journal is a json file of the form
+    {job_guid: {'states': [state, ...],
+                'uploads': {path: {'url': url, 'size': n, 'mtime': t}}}}
+    """
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.data = {}
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except IOError:
+            pass
+        except ValueError:
+            self.logger.warning('Ignoring corrupt submission journal %s' %
+                                self.path)
+
+    def save(self):
+        try:
+            write_json(self.path, self.data, indent=1)
+        except (IOError, OSError):
+            self.logger.exception('Unable to write submission journal %s' %
+                                  self.path)
+
+    def _entry(self, guid):
+        return self.data.setdefault(guid, {'states': [], 'uploads': {}})
+
+    def has_state(self, guid, state):
+        return state in self.data.get(guid, {}).get('states', [])
+
+    def add_states(self, guids, state):
+        for guid in guids:
+            states = self._entry(guid)['states']
+            if state not in states:
+                states.append(state)
+        self.save()
+
+    def get_upload(self, guid, path):
+        """ Return the url `path` was uploaded to for job `guid`, if the
+        file has not changed since.
+        """
+        upload = self.data.get(guid, {}).get('uploads', {}).get(path)
+        if not upload or not os.path.exists(path):
+            return None
+        st = os.stat(path)
+        if (upload['size'], upload['mtime']) != (st.st_size,
+                                                 int(st.st_mtime)):
+            return None
+        return upload['url']
+
+    def add_upload(self, guid, path, url):
+        st = os.stat(path)
+        self._entry(guid)['uploads'][path] = {'url': url,
+                                              'size': st.st_size,
+                                              'mtime': int(st.st_mtime)}
+        self.save()
 
 
 class TreeherderSubmission(object):
@@ -277,6 +526,14 @@ class TreeherderSubmission(object):
         self.tier = tier
         self.options = options
         self.s3_bucket = s3_bucket
+        # project -> guids of jobs posted during this run
+        self.posted_guids = {}
+        # path -> url of files shared between jobs, uploaded only once
+        self.shared_uploads = {}
+        self.metrics = SubmissionMetrics(
+            self.options.treeherder_statsd_address)
+        if self.s3_bucket and not self.s3_bucket.metrics:
+            self.s3_bucket.metrics = self.metrics
         self.logger.debug(type(self).__name__)
 
         self.url = self.options.treeherder_url
@@ -290,6 +547,18 @@ class TreeherderSubmission(object):
         self.credentials = self.options.treeherder_credentials
         self.retries = self.options.treeherder_retries
         self.retry_wait = self.options.treeherder_retry_wait
+        self.timeout = self.options.treeherder_timeout
+        self.artifact_max_size = self.options.treeherder_artifact_max_size
+        self.resolve_job_urls = self.options.treeherder_resolve_job_urls
+        self.content_addressed = (
+            self.options.treeherder_content_addressed_uploads)
+        self.upload_max_file_size = (
+            self.options.treeherder_upload_max_file_size)
+        self.upload_max_job_size = self.options.treeherder_upload_max_job_size
+        self.journal = None
+        if self.options.treeherder_journal_path:
+            self.journal = SubmissionJournal(
+                self.options.treeherder_journal_path, self.logger)
 
     def __str__(self):
         # Do not publish sensitive information
@@ -298,72 +567,144 @@ class TreeherderSubmission(object):
                      'protocol',
                      'host',
                      'retries',
-                     'retry_wait')
+                     'retry_wait',
+                     'timeout',
+                     'artifact_max_size',
+                     'resolve_job_urls',
+                     'content_addressed',
+                     'upload_max_file_size',
+                     'upload_max_job_size')
         d = {}
         for attr in whitelist:
             d[attr] = getattr(self, attr)
         return '%s' % d
 
-    def post_request(self, project, job_collection, guid=None):
+    def already_submitted(self, job, state):
+        """ Return True if the journal shows `job` was posted in `state` or
+        a later one.
+        """
+        if not self.journal:
+            return False
+        later_states = JobState.ORDER[JobState.ORDER.index(state):]
+        return any(self.journal.has_state(job.job_guid, s)
+                   for s in later_states)
+
+    def post_jobs(self, project, job_collection, jobs, state):
+        """ Post `job_collection` holding `jobs` in `state` and record the
+        state in the journal if the post succeeded. Returns False if the
+        post failed.
+        """
+        if not jobs:
+            self.logger.debug(type(self).__name__ +
+                              '.post_jobs: nothing left to submit')
+            return True
+        guids = [j.job_guid for j in jobs]
+        if not self.post_request(project, job_collection, guids):
+            return False
+        if self.journal:
+            self.journal.add_states(guids, state)
+        return True
+
+    def post_request(self, project, job_collection, guids=None):
         self.logger.debug(type(self).__name__ + '.post_request - '
                           'job_collection =\n%s' %
                           pretty(job_collection.get_collection_data()))
 
         client = TreeherderClient(protocol=self.protocol,
                                   host=self.server,
+                                  timeout=self.timeout,
                                   client_id=self.credentials['client_id'],
                                   secret=self.credentials['secret'])
-
+        payload_size = len(json.dumps(job_collection.get_collection_data()))
         for attempt in range(1, self.retries + 1):
+            if attempt > 1:
+                self.metrics.retry(COLLECTION_POST)
+            start = time.time()
             try:
                 client.post_collection(project, job_collection)
+                self.metrics.record(COLLECTION_POST, time.time() - start,
+                                    payload_size)
                 self.logger.info(type(self).__name__ +
                                  '.post_request - collection posted')
-                if guid:
-                    job_url = self.request_job_url(project, guid)
-                    self.logger.info(type(self).__name__ +
-                                     '.post_request - url is %s' % job_url)
-                return
+                if guids:
+                    # Job urls are looked up in one batch by finish()
+                    posted = self.posted_guids.setdefault(project, [])
+                    posted.extend(g for g in guids if g not in posted)
+                return True
             except requests.exceptions.Timeout:
+                self.metrics.record(COLLECTION_POST, time.time() - start,
+                                    payload_size, failed=True)
                 message = ('Attempt %d to post result to '
                            'Treeherder timed out.' % attempt)
                 self.logger.error(message)
                 time.sleep(self.retry_wait)
             except Exception as e:
+                self.metrics.record(COLLECTION_POST, time.time() - start,
+                                    payload_size, failed=True)
                 message = ('Error submitting request to Treeherder\n\n'
                            'Exception: %s\n'
                            'TreeherderJobCollection %s\n' %
                            (e, pretty(job_collection.get_collection_data())))
                 self.logger.exception(message)
-                return
+                return False
         self.logger.error('Error submitting request to Treeherder.')
+        return False
 
-    def request_job_url(self, project, guid):
-        """ Return the Treeherder log viewer URL for job with `guid`
-        :param project: repository name for the job
-        :param guid: guid of the job
+    def request_job_urls(self, project, guids):
+        """ Return a dict of guid to Treeherder log viewer URL for the jobs
+        with `guids`, using a single request.
+        :param project: repository name for the jobs
+        :param guids: list of job guids
         """
-        if not self.url or not project or not guid:
-            self.logger.debug(type(self).__name__ + '.request_job_url - '
-                              + 'missing url, project or guid.')
-            return None
-
-        job_api_url = '%s/api/project/%s/jobs/?job_guid=%s' % (self.url,
-                                                               project,
-                                                               guid)
-        response = get_from_treeherder(job_api_url, self.logger)
-
-        job_results = response.get('results')
-        if job_results:
-            job_id = job_results[0].get('id')
-            if job_id:
-                return '%s/logviewer.html#?job_id=%s&repo=%s' % (self.url,
-                                                                 job_id,
-                                                                 project)
-        message = 'job_id for guid %s not found for %s.\n' % (guid, project)
-        message += pretty(response)
-        self.logger.error(message)
-        return None
+        if not self.url or not project or not guids:
+            self.logger.debug(type(self).__name__ + '.request_job_urls - '
+                              + 'missing url, project or guids.')
+            return {}
+
+        # the jobs list is paginated; ask for all of them in one page
+        job_api_url = '%s/api/project/%s/jobs/?job_guid__in=%s&count=%d' % (
+            self.url, project, ','.join(guids), len(guids))
+        response = get_from_treeherder(job_api_url, self.logger,
+                                       self.metrics, JOBS_LOOKUP,
+                                       self.timeout)
+
+        urls = {}
+        for job in response.get('results') or []:
+            if job.get('job_guid') in guids and job.get('id'):
+                urls[job['job_guid']] = ('%s/logviewer.html#?job_id=%s&repo=%s'
+                                         % (self.url, job['id'], project))
+        missing = [g for g in guids if g not in urls]
+        if missing:
+            self.logger.warning('job_id for guids %s not found for %s.' %
+                                (', '.join(missing), project))
+        return urls
+
+    def finish(self):
+        """ Wrap up the run: log the Treeherder URLs of all jobs posted
+        by this submission, one lookup per project, and write the
+        submission metrics.
+        """
+        try:
+            if self.url and self.resolve_job_urls:
+                for project, guids in self.posted_guids.items():
+                    urls = self.request_job_urls(project, guids)
+                    for guid in guids:
+                        if guid in urls:
+                            self.logger.info(type(self).__name__ +
+                                             '.finish - url for %s is %s' %
+                                             (guid, urls[guid]))
+        finally:
+            self.posted_guids = {}
+            self.write_metrics()
+
+    def write_metrics(self):
+        """ Write the submission metrics, if a metrics path is set. """
+        if self.options.treeherder_metrics_path:
+            try:
+                self.metrics.write(self.options.treeherder_metrics_path)
+            except IOError:
+                self.logger.exception('Unable to write metrics to %s' %
+                                      self.options.treeherder_metrics_path)
 
     # based on request_treeherder_revision_hash at
     # https://github.com/mozilla/autophone/blob/master/utils.py
@@ -382,7 +723,9 @@ class TreeherderSubmission(object):
         rev = rev[:12]
         revurl = '%s/api/project/%s/resultset/?revision=%s' % (
             self.url, project, rev)
-        response = get_from_treeherder(revurl, self.logger)
+        response = get_from_treeherder(revurl, self.logger,
+                                       self.metrics, RESULTSET_LOOKUP,
+                                       self.timeout)
 
         rev_results = response.get('results')
         if rev_results:
@@ -396,24 +739,30 @@ class TreeherderSubmission(object):
     def submit_pending(self, jobs):
         """Submit jobs pending notifications to Treeherder
         :param jobs: Lists of jobs to be reported. (TestJob)
+        :returns: False if the jobs could not be submitted.
         """
         self.logger.debug(type(self).__name__ +
                           '.submit_pending: jobs =\n%s' % jobs)
         if not self.url or not jobs:
             self.logger.debug(type(self).__name__ +
                               '.submit_pending: no url/job')
-            return
+            return False
 
         tjc = TreeherderJobCollection()
+        submitted = []
 
         for j in jobs:
             project = j.build['repo']
+            if self.already_submitted(j, JobState.PENDING):
+                self.logger.info('submit_pending: %s already submitted; '
+                                 'skipping' % j.job_guid)
+                continue
             revision = j.build['revision']
             revision_hash = self.request_revision_hash(project, revision)
             if not revision_hash:
                 self.logger.debug(type(self).__name__ +
                                   '.submit_pending: no revision hash')
-                return
+                return False
             j.submit_timestamp = timestamp_now()
 
             self.logger.info('creating Treeherder job %s for %s %s, '
@@ -450,30 +799,37 @@ class TreeherderSubmission(object):
             tj.add_option_collection({'opt': True})
 
             tjc.add(tj)
+            submitted.append(j)
 
-        self.post_request(project, tjc, j.job_guid)
+        return self.post_jobs(project, tjc, submitted, JobState.PENDING)
 
     def submit_running(self, jobs):
         """Submit jobs running notifications to Treeherder
         :param jobs: Lists of jobs to be reported. (TestJob)
+        :returns: False if the jobs could not be submitted.
         """
         self.logger.debug(type(self).__name__ +
                           '.submit_running: jobs =\n%s' % jobs)
         if not self.url or not jobs:
             self.logger.debug(type(self).__name__ +
                               '.submit_running: no url/job')
-            return
+            return False
 
         tjc = TreeherderJobCollection()
+        submitted = []
 
         for j in jobs:
             project = j.build['repo']
+            if self.already_submitted(j, JobState.RUNNING):
+                self.logger.info('submit_running: %s already submitted; '
+                                 'skipping' % j.job_guid)
+                continue
             revision = j.build['revision']
             revision_hash = self.request_revision_hash(project, revision)
             if not revision_hash:
                 self.logger.debug(type(self).__name__ +
                                   '.submit_running: no revision hash')
-                return
+                return False
             self.logger.debug(type(self).__name__ + '.submit_running: '
                               'for %s %s' % (j.name, project))
 
@@ -514,7 +870,8 @@ class TreeherderSubmission(object):
             tj.add_option_collection({'opt': True})
 
             tjc.add(tj)
-        self.post_request(project, tjc, j.job_guid)
+            submitted.append(j)
+        return self.post_jobs(project, tjc, submitted, JobState.RUNNING)
 
     def submit_complete(self, jobs):
         """ Submit results to Treeherder, including uploading logs.
@@ -522,122 +879,267 @@ class TreeherderSubmission(object):
         TreeherderJobCollection.
 
         :param jobs: list of jobs (TestJob).
+        :returns: False if the jobs could not be submitted.
         """
         self.logger.debug(type(self).__name__ +
                           '.submit_complete: jobs =\n%s' % jobs)
         if not self.url or not jobs:
             self.logger.debug(type(self).__name__ +
                               '.submit_complete: no url/job')
-            return
+            return False
 
         tjc = TreeherderJobCollection()
+        submitted = []
+        # Parse logs in the background while they are being uploaded, skipping
+        # jobs whose completion the journal already has
+        pool, parsing = self.parse_logs_async(
+            [j for j in jobs
+             if not self.already_submitted(j, JobState.COMPLETED)])
+
+        try:
+            for j in jobs:
+                project = j.build['repo']
+                if self.already_submitted(j, JobState.COMPLETED):
+                    self.logger.info('submit_complete: %s already submitted; '
+                                     'skipping' % j.job_guid)
+                    continue
+                revision = j.build['revision']
+                revision_hash = self.request_revision_hash(project, revision)
+                if not revision_hash:
+                    self.logger.debug(type(self).__name__ +
+                                      '.submit_complete: no revision hash')
+                    return False
+                self.logger.debug(type(self).__name__ + '.submit_complete '
+                                  'for %s %s' % (j.name, project))
+                j.end_timestamp = timestamp_now()
+                # A usercancelled job may not have a start_timestamp
+                # since it may have been cancelled before it started.
+                if not j.start_timestamp:
+                    j.start_timestamp = j.end_timestamp
+                # If a 'pending' submission was never made for this job,
+                # the submit_timestamp may be blank.
+                if not j.submit_timestamp:
+                    j.submit_timestamp = j.end_timestamp
+
+                if j.test_result:
+                    if j.test_result.failed == 0:
+                        failed = '0'
+                    else:
+                        failed = ('<em class="testfail">%s</em>'
+                                  % j.test_result.failed)
+
+                    j.job_details.append({
+                        'value': "%s/%s/%s" % (j.test_result.passed,
+                                               failed, j.test_result.todo),
+                        'content_type': 'raw_html',
+                        'title': "%s-%s (pass/fail/todo)" % (j.job_name,
+                                                             j.job_symbol)
+                    })
+
+                tj = tjc.get_job()
+                tj.add_tier(self.tier)
+                tj.add_description(j.description)
+                tj.add_reason(j.reason)
+                tj.add_revision_hash(revision_hash)
+                tj.add_project(project)
+                tj.add_who(j.who)
+                # Note: job_guid should be added before artifacts.
+                tj.add_job_guid(j.job_guid)
+                tj.add_job_name(j.job_name)
+                tj.add_job_symbol(j.job_symbol)
+                tj.add_group_name(j.group_name)
+                tj.add_group_symbol(j.group_symbol)
+                tj.add_product_name(j.build['product'])
+                tj.add_state(JobState.COMPLETED)
+                tj.add_result(j.result)
+                tj.add_submit_timestamp(j.submit_timestamp)
+                tj.add_start_timestamp(j.start_timestamp)
+                tj.add_end_timestamp(j.end_timestamp)
+                tj.add_build_info(j.build['os_name'],
+                                  j.build['platform'],
+                                  j.build['architecture'])
+                tj.add_machine(j.machine['host'])
+                tj.add_machine_info(j.machine['os_name'],
+                                    j.machine['platform'],
+                                    j.machine['architecture'])
+                tj.add_option_collection({'opt': True})
+
+                # Job details and other artifacts
+
+                # Create/add text_log_summary for each log that should be
+                # parsed
+                def build_log_artifacts(log_file, log_url):
+                    log_name = os.path.basename(log_file)
+                    if (not log_url) or (log_file not in j.parsed_logs):
+                        return
+                    tj.add_log_reference(log_name, log_url,
+                                         parse_status='parsed')
+                    # NOTE must have started_linenumber < finished_linenumber
+                    text_log_summary = None
+                    if log_file in parsing:
+                        try:
+                            text_log_summary = parsing[log_file].get()
+                            text_log_summary['logurl'] = log_url
+                        except Exception:
+                            self.logger.exception('Parsing %s in log parser '
+                                                  'pool failed' % log_file)
+                    if text_log_summary is None:
+                        text_log_summary = parse_log(log_file, log_url,
+                                                     self.logger)
+                    tj.add_artifact('text_log_summary', 'json',
+                                    json.dumps(text_log_summary))
+                    self.logger.debug(type(self).__name__ +
+                                      '.submit_complete text_log_summary: %s' %
+                                      pretty(text_log_summary))
+
+                # File uploads
+                if self.s3_bucket:
+                    self.upload_job_files(j, build_log_artifacts)
+                tj.add_artifact('Job Info', 'json',
+                                {'job_details': j.job_details})
+                for a in j.artifacts:
+                    if self.s3_bucket and self.artifact_max_size:
+                        a = self.offload_large_artifact(j, a)
+                    tj.add_artifact(*a)
+
+                tjc.add(tj)
+                submitted.append(j)
+
+                message = j.message
+                if j.test_result:
+                    message += '\nTestResult: %s %s' % (j.test_result.status,
+                                                        j.name)
+                if message:
+                    self.logger.info(message)
+        finally:
+            if pool:
+                # stop parsers whose results are no longer wanted, e.g.
+                # after an early return
+                pool.terminate()
+                pool.join()
+        return self.post_jobs(project, tjc, submitted, JobState.COMPLETED)
+
+    def parse_logs_async(self, jobs):
+        """ Start parsing the parsed_logs of `jobs` in a process pool, so
+        several large logs are parsed in parallel and alongside uploads.
+        Returns the pool (or None) and a dict of log path to AsyncResult.
+        """
+        log_files = []
+        if self.s3_bucket:
+            for j in jobs:
+                log_files.extend(f for f in j.parsed_logs
+                                 if f not in log_files and os.path.exists(f))
+        if not log_files:
+            return None, {}
+        try:
+            pool = multiprocessing.Pool(min(len(log_files),
+                                            multiprocessing.cpu_count()))
+        except (OSError, NotImplementedError):
+            self.logger.exception('Unable to start log parser pool; '
+                                  'parsing logs serially')
+            return None, {}
+        parsing = dict((f, pool.apply_async(_parse_log_worker, (f,)))
+                       for f in log_files)
+        pool.close()
+        return pool, parsing
+
+    def upload_job_files(self, job, uploaded):
+        """ Upload the files of `job` in plan_uploads() order, truncating
+        text files to stay within the per-file and per-job size caps and
+        skipping other oversized files and the rest once the job cap is used
+        up.
+        :param uploaded: called with (path, url) after each upload attempt
+        """
+        def skip(message):
+            self.logger.warning(message)
+            job.job_details.append({
+                'value': message,
+                'content_type': 'text',
+                'title': 'Error'})
 
-        for j in jobs:
-            project = j.build['repo']
-            revision = j.build['revision']
-            revision_hash = self.request_revision_hash(project, revision)
-            if not revision_hash:
-                self.logger.debug(type(self).__name__ +
-                                  '.submit_complete: no revision hash')
-                return
-            self.logger.debug(type(self).__name__ + '.submit_complete '
-                              'for %s %s' % (j.name, project))
-            j.end_timestamp = timestamp_now()
-            # A usercancelled job may not have a start_timestamp
-            # since it may have been cancelled before it started.
-            if not j.start_timestamp:
-                j.start_timestamp = j.end_timestamp
-            # If a 'pending' submission was never made for this job,
-            # the submit_timestamp may be blank.
-            if not j.submit_timestamp:
-                j.submit_timestamp = j.end_timestamp
-
-            if j.test_result:
-                if j.test_result.failed == 0:
-                    failed = '0'
+        remaining = self.upload_max_job_size or None
+        for path, shared in plan_uploads(job):
+            if shared and path in self.shared_uploads:
+                uploaded(path, self.upload_shared_file(job, path))
+                continue
+            limit = self.upload_max_file_size or None
+            if remaining is not None:
+                limit = remaining if limit is None else min(limit, remaining)
+            if limit is not None and limit <= 0:
+                skip('Skipped %s: job upload limit of %d bytes reached.' %
+                     (os.path.basename(path), self.upload_max_job_size))
+                continue
+            size = os.path.getsize(path) if os.path.isfile(path) else 0
+            tmpdir = None
+            upload_path = path
+            if limit is not None and size > limit:
+                if not is_text_file(path):
+                    skip('Skipped %s: %d bytes exceeds the upload limit of '
+                         '%d bytes.' % (os.path.basename(path), size, limit))
+                    continue
+                self.logger.info('Truncating %s from %d to %d bytes for '
+                                 'upload' % (path, size, limit))
+                tmpdir = tempfile.mkdtemp()
+                upload_path = truncate_file(path, limit, tmpdir)
+                size = os.path.getsize(upload_path)
+            try:
+                if shared:
+                    url = self.upload_shared_file(job, path, upload_path)
                 else:
-                    failed = ('<em class="testfail">%s</em>'
-                              % j.test_result.failed)
-
-                j.job_details.append({
-                    'value': "%s/%s/%s" % (j.test_result.passed,
-                                           failed, j.test_result.todo),
-                    'content_type': 'raw_html',
-                    'title': "%s-%s (pass/fail/todo)" % (j.job_name,
-                                                         j.job_symbol)
-                })
-
-            tj = tjc.get_job()
-            tj.add_tier(self.tier)
-            tj.add_description(j.description)
-            tj.add_reason(j.reason)
-            tj.add_revision_hash(revision_hash)
-            tj.add_project(project)
-            tj.add_who(j.who)
-            # Note: job_guid should be added before artifacts.
-            tj.add_job_guid(j.job_guid)
-            tj.add_job_name(j.job_name)
-            tj.add_job_symbol(j.job_symbol)
-            tj.add_group_name(j.group_name)
-            tj.add_group_symbol(j.group_symbol)
-            tj.add_product_name(j.build['product'])
-            tj.add_state(JobState.COMPLETED)
-            tj.add_result(j.result)
-            tj.add_submit_timestamp(j.submit_timestamp)
-            tj.add_start_timestamp(j.start_timestamp)
-            tj.add_end_timestamp(j.end_timestamp)
-            tj.add_build_info(j.build['os_name'],
-                              j.build['platform'],
-                              j.build['architecture'])
-            tj.add_machine(j.machine['host'])
-            tj.add_machine_info(j.machine['os_name'],
-                                j.machine['platform'],
-                                j.machine['architecture'])
-            tj.add_option_collection({'opt': True})
-
-            # Job details and other artifacts
-
-            # Create/add text_log_summary for each log that should be parsed
-            def build_log_artifacts(log_file, log_url):
-                log_name = os.path.basename(log_file)
-                if (not log_url) or (log_file not in j.parsed_logs):
-                    return
-                tj.add_log_reference(log_name, log_url, parse_status='parsed')
-                # NOTE must have started_linenumber < finished_linenumber
-                text_log_summary = parse_log(log_file, log_url, self.logger)
-                tj.add_artifact('text_log_summary', 'json',
-                                json.dumps(text_log_summary))
-                self.logger.debug(type(self).__name__ +
-                                  '.submit_complete text_log_summary: %s' %
-                                  pretty(text_log_summary))
-
-            # File uploads
-            if self.s3_bucket:
-                prefix = j.unique_s3_prefix
-                filepaths = j.log_files + j.config_files
-                for path in filepaths:
-                    url = upload_file(self.s3_bucket, prefix,
-                                      path, self.logger, j)
-                    build_log_artifacts(path, url)
-                if j.upload_dir:
-                    for f in glob.glob(os.path.join(j.upload_dir, '*')):
-                        url = upload_file(self.s3_bucket, prefix, f,
-                                          self.logger, j)
-                        build_log_artifacts(path, url)
-            tj.add_artifact('Job Info', 'json', {'job_details': j.job_details})
-            for a in j.artifacts:
-                tj.add_artifact(*a)
-
-            tjc.add(tj)
-
-            message = j.message
-            if j.test_result:
-                message += '\nTestResult: %s %s' % (j.test_result.status,
-                                                    j.name)
-            if message:
-                self.logger.info(message)
-
-        self.post_request(project, tjc, j.job_guid)
+                    url = upload_file(self.s3_bucket, job.unique_s3_prefix,
+                                      upload_path, self.logger, job,
+                                      self.journal, self.content_addressed,
+                                      journal_key=path)
+            finally:
+                if tmpdir:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+            if url and remaining is not None:
+                remaining -= size
+            uploaded(path, url)
+
+    def upload_shared_file(self, job, path, upload_path=None):
+        """ Upload `path`, one of the shared_files of `job`, unless it was
+        already uploaded for another job, and link it from the job details.
+        :param upload_path: file to upload in place of `path`, e.g. a
+                            truncated copy
+        """
+        url = self.shared_uploads.get(path)
+        if url:
+            self.logger.info('Shared artifact already uploaded to %s' % url)
+            job.job_details.append({
+                'url': url,
+                'value': os.path.basename(path),
+                'content_type': 'link',
+                'title': 'artifact uploaded'})
+            return url
+        url = upload_file(self.s3_bucket, job.unique_s3_prefix,
+                          upload_path or path, self.logger, job,
+                          self.journal, self.content_addressed,
+                          journal_key=path)
+        if url:
+            self.shared_uploads[path] = url
+        return url
+
+    def offload_large_artifact(self, job, artifact):
+        """ Return `artifact` unchanged if its blob is small enough to be
+        posted to Treeherder, otherwise upload it to S3 and return a
+        reference artifact pointing at its url.
+        :param job: TestJob that owns the artifact
+        :param artifact: tuple of name, type, blob
+        """
+        blob = artifact[2]
+        if not isinstance(blob, basestring):
+            blob = json.dumps(blob)
+        if isinstance(blob, unicode):
+            blob = blob.encode('utf-8')
+        if len(blob) <= self.artifact_max_size:
+            return artifact
+        self.logger.info(type(self).__name__ + '.offload_large_artifact - '
+                         '%s is %d bytes; uploading to S3' % (artifact[0],
+                                                              len(blob)))
+        reference = offload_artifact(self.s3_bucket, job.unique_s3_prefix,
+                                     artifact, self.logger)
+        return reference or artifact
 
 
 # based on https://github.com/mozilla/autophone/blob/master/options.py
@@ -652,6 +1154,27 @@ class TreeherderOptions(object):
         self.treeherder_credentials_path = ''
         self.treeherder_retries = 5
         self.treeherder_retry_wait = 5
+        # seconds before a Treeherder request times out
+        self.treeherder_timeout = 120
+        # artifacts larger than this many bytes are uploaded to S3 and
+        # replaced by a reference; 0 disables offloading
+        self.treeherder_artifact_max_size = 256 * 1024
+        # look up job urls for the log once all jobs have been submitted
+        self.treeherder_resolve_job_urls = True
+        # store uploads under content-addressed keys and skip uploading
+        # files that are already stored
+        self.treeherder_content_addressed_uploads = False
+        # byte caps for a single uploaded file and for all of a job's
+        # uploads; larger files are truncated; 0 means no cap
+        self.treeherder_upload_max_file_size = 0
+        self.treeherder_upload_max_job_size = 0
+        # optional path of a SubmissionJournal used to skip states and
+        # uploads already submitted for a job_guid
+        self.treeherder_journal_path = ''
+        # optional json file for submission metrics, written by finish()
+        self.treeherder_metrics_path = ''
+        # optional 'host:port' of a statsd UDP sink for submission metrics
+        self.treeherder_statsd_address = ''
         self._treeherder_protocol = ''
         self._treeherder_server = ''
         # same format as credentials.json generation by
@@ -680,6 +1203,12 @@ class TreeherderOptions(object):
         whitelist = ('treeherder_url',
                      'treeherder_retries',
                      'treeherder_retry_wait',
+                     'treeherder_timeout',
+                     'treeherder_artifact_max_size',
+                     'treeherder_resolve_job_urls',
+                     'treeherder_content_addressed_uploads',
+                     'treeherder_upload_max_file_size',
+                     'treeherder_upload_max_job_size',
                      '_treeherder_protocol',
                      '_treeherder_server',)
         d = {}
@@ -691,8 +1220,191 @@ class TreeherderOptions(object):
         return self.__str__()
 
 
+def _intern(value):
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+class JobRecord(object):
+    """ Compact dict-like record with a fixed set of fields, used for the
+    build and machine info of a TestJob. String values are interned, and
+    shared() returns a read-only instance common to all jobs with the same
+    values.
+    """
+    FIELDS = ()
+    __slots__ = ('__weakref__', '_shared')
+
+    def __init__(self, *args, **kwargs):
+        self._shared = False
+        for field in self.FIELDS:
+            setattr(self, field, '')
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        if self._shared:
+            raise TypeError('%s is shared and read-only' %
+                            type(self).__name__)
+        setattr(self, field, _intern(value))
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, JobRecord):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, field, default=None):
+        if field not in self.FIELDS:
+            return default
+        return getattr(self, field)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.FIELDS]
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            if hasattr(other, 'items'):
+                other = other.items()
+            for field, value in other:
+                self[field] = value
+
+    def copy(self):
+        return type(self)(self.items())
+
+    def shared(self):
+        """ Return a read-only record with the same values, shared with any
+        other job that has them.
+        """
+        key = (type(self),) + tuple(self.items())
+        record = _shared_records.get(key)
+        if record is None:
+            record = self.copy()
+            record._shared = True
+            _shared_records[key] = record
+        return record
+
+
+# (record type, values) -> shared JobRecord
+_shared_records = weakref.WeakValueDictionary()
+
+
+class BuildInfo(JobRecord):
+    FIELDS = ('product',
+              'release',
+              'repo',
+              # Used in Treeherder build info: win, mac, linux
+              'os_name',
+              # Used in Treeherder revision summary,
+              # ex: 'windows7-64' will be displayed as Windows 7 x64
+              'platform',
+              # Used in Treeheder build info: x86, x86_64
+              'architecture',
+              'package',
+              'revision',
+              'build_id')
+    __slots__ = FIELDS
+
+
+class MachineInfo(JobRecord):
+    FIELDS = ('os_name',
+              # Used in Treeherder revision summary,
+              # ex: 'windows7-64' will be displayed as Windows 7 x64
+              'platform',
+              'architecture',
+              'host')
+    __slots__ = FIELDS
+
+
+def _lazy(name, factory):
+    """ Property for a container attribute stored in slot `name` that is
+    only created when first used.
+    """
+    def getter(self):
+        value = getattr(self, name)
+        if value is None:
+            value = factory()
+            setattr(self, name, value)
+        return value
+
+    def setter(self, value):
+        setattr(self, name, value)
+    return property(getter, setter)
+
+
 class TestJob(object):
-    """ Public job data that is relevant to Treeherder """
+    """ Public job data that is relevant to Treeherder
+
+    Jobs use __slots__ and create their lists only when used, so that a
+    coordinator can keep thousands of them in flight; see also
+    share_records().
+    """
+    __slots__ = ('name',
+                 'job_name',
+                 'job_symbol',
+                 'job_guid',
+                 'group_name',
+                 'group_symbol',
+                 'description',
+                 'start_timestamp',
+                 'end_timestamp',
+                 'submit_timestamp',
+                 '_log_files',
+                 '_shared_files',
+                 '_config_files',
+                 'upload_dir',
+                 'upload_dir_include',
+                 'upload_dir_exclude',
+                 '_job_details',
+                 '_artifacts',
+                 'build',
+                 'machine',
+                 'result',
+                 'test_result',
+                 'reason',
+                 'who',
+                 'message',
+                 '_parsed_logs')
+
+    # Data that we might upload to S3
+    # Expecting absolute paths
+    log_files = _lazy('_log_files', list)
+    # Files shared with other jobs submitted by the same
+    # TreeherderSubmission, e.g. both jobs of a steeplechase pair;
+    # uploaded once and linked from each job.
+    shared_files = _lazy('_shared_files', list)
+    config_files = _lazy('_config_files', list)
+    # For special 'Job Info' artifact retrieved by Treeherder UI.
+    # List of dicts.
+    # May include test results, links to logs, etc.
+    job_details = _lazy('_job_details', list)
+    artifacts = _lazy('_artifacts', list)  # tuples of name, type, blob
+    # logs that should be parsed for text_log_summary artifact
+    parsed_logs = _lazy('_parsed_logs', list)
+
     def __init__(self, **kwargs):
         self.name = ''  # internal name
         self.job_name = ''
@@ -704,49 +1416,36 @@ class TestJob(object):
         self.start_timestamp = ''
         self.end_timestamp = ''
         self.submit_timestamp = ''
-        # Data that we might upload to S3
-        # Expecting absolute paths
-        self.log_files = []
-        self.config_files = []
+        self._log_files = None
+        self._shared_files = None
+        self._config_files = None
         self.upload_dir = ''
-        # For special 'Job Info' artifact retrieved by Treeherder UI.
-        # List of dicts.
-        # May include test results, links to logs, etc.
-        self.job_details = []
-        self.artifacts = []  # tuples of name, type, blob
-        self.build = {
-            'product': 'Firefox',
-            'release': '',
-            'repo': '',
-            # Used in Treeherder build info: win, mac, linux
-            'os_name': '',
-            # Used in Treeherder revision summary,
-            # ex: 'windows7-64' will be displayed as Windows 7 x64
-            'platform': '',
-            # Used in Treeheder build info: x86, x86_64
-            'architecture': '',
-            'package': '',
-            'revision': '',
-            'build_id': '',
-        }
-        self.machine = {
-            'os_name': '',
-            # Used in Treeherder revision summary,
-            # ex: 'windows7-64' will be displayed as Windows 7 x64
-            'platform': '',
-            'architecture': '',
-            'host': ''
-        }
+        # fnmatch patterns selecting which upload_dir files are uploaded
+        self.upload_dir_include = ('*',)
+        self.upload_dir_exclude = ()
+        self._job_details = None
+        self._artifacts = None
+        self.build = BuildInfo(product='Firefox')
+        self.machine = MachineInfo()
         self.result = ''
         # should have str/int status, passed, failed, todo attributes
         # e.g. https://github.com/mozilla/autophone/blob/master/phonetest.py#L554 PhoneTestResult
         self.test_result = None
         self.reason = ''
-        self.description = ''
         self.who = ''
         self.message = ''  # e.g. summary to report alongside test results
-        # logs that should be parsed for text_log_summary artifact
-        self.parsed_logs = []
+        self._parsed_logs = None
+
+    def share_records(self):
+        """ Replace build and machine info with read-only records shared by
+        all jobs with the same values, and intern the job's descriptive
+        strings. Call once the build and machine info are final.
+        """
+        self.build = self.build.shared()
+        self.machine = self.machine.shared()
+        for attr in ('job_name', 'job_symbol', 'group_name', 'group_symbol',
+                     'description', 'reason', 'who'):
+            setattr(self, attr, _intern(getattr(self, attr)))
 
     @property
     def unique_s3_prefix(self):
@@ -776,10 +1475,13 @@ class TestJob(object):
                      'job_details',
                      'artifacts',
                      'log_files',
+                     'shared_files',
                      'config_files')
         d = {}
         for attr in whitelist:
             d[attr] = getattr(self, attr)
+            if isinstance(d[attr], JobRecord):
+                d[attr] = dict(d[attr].items())
         return pretty(d)
 
     def __repr__(self):
@@ -7,8 +7,6 @@
 """Submits jenkins steeplechase WebRTC test results to treeherder"""
 
 from ConfigParser import ConfigParser
-import glob
-import hashlib
 import json
 import logging
 import os
@@ -21,12 +19,13 @@ import subprocess
 import mozlog
 import traceback
 
-from s3 import S3Bucket
+from storage import open_storage, test_active
 
 import sclogparse
 import treeherder_config
 from treeherding import (TestJob, TreeherderSubmission, TreeherderOptions,
-                         timestamp_now, get_platform_attributes)
+                         timestamp_now, get_platform_attributes,
+                         stable_job_guid)
 
 logging.basicConfig()
 logger = mozlog.unstructured.getLogger('jenkinsherder')
@@ -35,6 +34,8 @@ logger.setLevel(logging.DEBUG)
 
 class SteeplechaseJob(TestJob):
     """ Public job data that is relevant to Treeherder """
+    __slots__ = ('jenkins_build_tag', 'jenkins_build_url')
+
     def __init__(self, platform_info, **kwargs):
         super(SteeplechaseJob, self).__init__(**kwargs)
         self.jenkins_build_tag = '' # computed
@@ -83,6 +84,16 @@ def get_config(argv):
     parser.add_argument('--treeherder-url')
     parser.add_argument('--treeherder-credentials-path')
     parser.add_argument('--s3-credentials-path')
+    parser.add_argument('--submission-journal', dest='submission_journal',
+                        default='')
+    parser.add_argument('--metrics-path', dest='metrics_path', default='')
+    parser.add_argument('--statsd-address', dest='statsd_address', default='')
+    parser.add_argument('--content-addressed-uploads', action='store_true',
+                        dest='content_addressed_uploads')
+    parser.add_argument('--upload-max-file-size', type=int, default=0,
+                        dest='upload_max_file_size')
+    parser.add_argument('--upload-max-job-size', type=int, default=0,
+                        dest='upload_max_job_size')
     args = parser.parse_args(argv)
 
     pfi = platform_info(args.package, args.arch1, args.host1, args.os1)
@@ -123,6 +134,12 @@ def get_config(argv):
         config['treeherder_credentials_path'] = args.treeherder_credentials_path
     if args.s3_credentials_path:
         config['s3_credentials_path'] = args.s3_credentials_path
+    config['submission_journal'] = args.submission_journal
+    config['metrics_path'] = args.metrics_path
+    config['statsd_address'] = args.statsd_address
+    config['content_addressed_uploads'] = args.content_addressed_uploads
+    config['upload_max_file_size'] = args.upload_max_file_size
+    config['upload_max_job_size'] = args.upload_max_job_size
     config['no_treeherding'] = args.no_treeherding or False
 
     return config
@@ -300,10 +317,7 @@ def get_s3_bucket(credentials_path):
         with open(credentials_path) as f:
             config_string = f.read()
             s3_config = json.loads(config_string)
-            return S3Bucket(s3_config['s3_bucket_name'],
-                            s3_config['aws_access_key_id'],
-                            s3_config['aws_access_key'],
-                            logger)
+            return open_storage(s3_config, logger)
     except IOError:
         msg = ('S3 credentials file not '
                'found at {0}.'.format(credentials_path))
@@ -316,13 +330,26 @@ def main(argv):
                                             indent=4,
                                             separators=(',', ': ')))
 
+    # State directory of the upload throttle, if uploads are throttled
+    throttle_dir = None
     if not config['no_treeherding']:
         th_options = get_treeherder_options(
                         config['treeherder_url'],
                         config['treeherder_credentials_path'])
         try:
-            treeherder = TreeherderSubmission(logger, th_options,
-                            get_s3_bucket(config['s3_credentials_path']))
+            th_options.treeherder_journal_path = config['submission_journal']
+            th_options.treeherder_metrics_path = config['metrics_path']
+            th_options.treeherder_statsd_address = config['statsd_address']
+            th_options.treeherder_content_addressed_uploads = (
+                config['content_addressed_uploads'])
+            th_options.treeherder_upload_max_file_size = (
+                config['upload_max_file_size'])
+            th_options.treeherder_upload_max_job_size = (
+                config['upload_max_job_size'])
+            s3_bucket = get_s3_bucket(config['s3_credentials_path'])
+            treeherder = TreeherderSubmission(logger, th_options, s3_bucket)
+            if getattr(s3_bucket, 'throttle', None):
+                throttle_dir = s3_bucket.throttle.state_dir
         except Exception:
             logger.error('Setup of Treeherder submission '
                          'failed: %s' % traceback.format_exc())
@@ -330,6 +357,14 @@ def main(argv):
         # Each job represents one Firefox instance in the WebRTC pair
         job1 = SteeplechaseJob(config['platform_info'])
         job2 = SteeplechaseJob(config['platform_info2'])
+        if config['submission_journal'] and config['jenkins_build_tag']:
+            # A re-run of this build must reuse the guids the journal has
+            # recorded
+            job1.job_guid = stable_job_guid(config['jenkins_build_tag'], 1)
+            job2.job_guid = stable_job_guid(config['jenkins_build_tag'], 2)
+        elif config['submission_journal']:
+            logger.warning('No Jenkins build tag; the submission journal '
+                           'cannot match jobs of a re-run.')
         for j in [job1, job2]:
             j.job_name = config['job_name']
             j.job_symbol = config['job_symbol']
@@ -353,9 +388,11 @@ def main(argv):
     sclog = mozlog.unstructured.getLogger('steeplechase')
     sclog.setLevel(logging.DEBUG)
 
-    # First, run steeplechase.
+    # First, run steeplechase. Throttled uploads on this node are slowed
+    # down or deferred meanwhile.
     try:
-        sclog, status = run_steeplechase(config, sclog)
+        with test_active(throttle_dir, logger):
+            sclog, status = run_steeplechase(config, sclog)
     except Exception as e:
         sclog.info("Running steeplechase failed: %s" % traceback.format_exc())
 
@@ -377,7 +414,8 @@ def main(argv):
     if not config['no_treeherding']:
         job1.end_timestamp = job2.end_timestamp = timestamp_now()
         for j in [job1, job2]:
-            j.log_files += log_files
+            # Both jobs link to the same uploaded steeplechase logs
+            j.shared_files += log_files
             j.result = result_string
             j.job_details += job_details
             j.jenkins_build_tag = config['jenkins_build_tag']
@@ -400,13 +438,17 @@ def main(argv):
                     failures = ['Total failed: %s' % results['total failed']]
                 j.parsed_logs[log_files[0]] = failures
         try:
-            if job1.build['repo'] == job2.build['repo']:
-                treeherder.submit_complete([job1, job2])
-            else:
-                # Jobs that belong to different repos cannot be submitted in one
-                # collection
-                treeherder.submit_complete([job1])
-                treeherder.submit_complete([job2])
+            try:
+                if job1.build['repo'] == job2.build['repo']:
+                    treeherder.submit_complete([job1, job2])
+                else:
+                    # Jobs that belong to different repos cannot be submitted
+                    # in one collection
+                    treeherder.submit_complete([job1])
+                    treeherder.submit_complete([job2])
+            finally:
+                # metrics of a failed submission matter the most
+                treeherder.finish()
         except Exception as e:
             logger.error('Treeherder submission '
                          'failed: %s' % traceback.format_exc())
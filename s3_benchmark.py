@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Upload throughput benchmark for the storage backends.
+
+Generates synthetic corpora of test logs and screenshots and uploads them
+through StorageBackend.upload for each combination of corpus, compression
+level and concurrency, reporting MB/s, CPU seconds per MB and peak memory.
+
+Uploads go through S3Bucket to a local S3 stand-in (s3_standin.py) by
+default, so compression, multipart uploads and part threads are all
+exercised; or to the backend described by an s3 credentials json file
+(--storage-config). Compression levels only apply to the s3 backend;
+LocalStorage stores files as is.
+"""
+
+import argparse
+import json
+import logging
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import s3_standin
+from storage import open_storage
+
+logging.basicConfig()
+logger = logging.getLogger('s3_benchmark')
+logger.setLevel(logging.INFO)
+
+MB = 1024 * 1024
+
+LOG_WORDS = ('TEST-PASS', 'TEST-UNEXPECTED-FAIL', 'INFO', 'DEBUG', 'WARNING',
+             'PeerConnection', 'getUserMedia', 'ICE', 'candidate', 'gathering',
+             'completed', 'audio', 'video', 'track', 'frames', 'decoded',
+             'Assertion', 'mozilla::dom', 'media.peerconnection', 'ms')
+
+# corpus name -> list of (kind of file, file size in bytes, number of files)
+CORPORA = {
+    'logs': [('log', 256 * 1024, 16),
+             ('log', 4 * MB, 4),
+             ('log', 32 * MB, 1)],
+    'screenshots': [('screenshot', 200 * 1024, 32)],
+}
+CORPORA['mixed'] = CORPORA['logs'] + CORPORA['screenshots']
+
+
+def make_log(path, size, rng):
+    """ Write about `size` bytes of test-log-like text to `path`. """
+    written = 0
+    with open(path, 'w') as f:
+        while written < size:
+            line = '%02d:%02d:%02d %s | test_%d.html | %s\n' % (
+                rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                rng.choice(LOG_WORDS), rng.randint(0, 500),
+                ' '.join(rng.choice(LOG_WORDS)
+                         for _ in range(rng.randint(3, 12))))
+            f.write(line)
+            written += len(line)
+
+
+def make_screenshot(path, size, rng):
+    """ Write a `size` byte file of incompressible data with a png
+    signature to `path`.
+    """
+    with open(path, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(os.urandom(size - 8))
+
+
+def make_corpus(directory, name, scale, seed=0):
+    """ Generate corpus `name` in `directory`, with file sizes multiplied by
+    `scale`, and return the paths of its files.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for kind, size, count in CORPORA[name]:
+        size = max(1024, int(size * scale))
+        for i in range(count):
+            if kind == 'screenshot':
+                path = os.path.join(directory, 'screenshot-%d-%d.png' %
+                                    (size, i))
+                make = make_screenshot
+            else:
+                path = os.path.join(directory, 'log-%d-%d.log' % (size, i))
+                make = make_log
+            if not os.path.exists(path):
+                make(path, size, rng)
+            paths.append(path)
+    return paths
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform == 'darwin':
+        return rss / float(MB)
+    return rss / 1024.0
+
+
+def run_scenario(storage_config, paths, level, concurrency):
+    """ Upload `paths` with `concurrency` uploads at a time and return the
+    measurements. Runs in a fresh process so peak memory is per scenario.
+    `level` is the compression level, 0 for none or None for the size based
+    default.
+    """
+    if level is not None:
+        storage_config = dict(storage_config, compression_level=level)
+    storage = open_storage(storage_config, logger)
+    prefix = 'benchmark/%s/' % uuid.uuid4()
+
+    def upload(item):
+        i, path = item
+        name = os.path.basename(path)
+        storage.upload(path, '%s%d-%s' % (prefix, i, name))
+
+    source_bytes = sum(os.path.getsize(path) for path in paths)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    pool = ThreadPool(concurrency)
+    try:
+        pool.map(upload, enumerate(paths))
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = ((after.ru_utime - usage.ru_utime) +
+                   (after.ru_stime - usage.ru_stime))
+    stored_bytes = sum(key.size or 0 for key in storage.ls('.*', prefix))
+    storage.rm(storage.ls('.*', prefix))
+    source_mb = source_bytes / float(MB)
+    return {
+        'files': len(paths),
+        'source_mb': source_mb,
+        'stored_mb': stored_bytes / float(MB),
+        'seconds': seconds,
+        'mb_per_second': source_mb / seconds if seconds else 0.0,
+        'cpu_seconds_per_mb': cpu_seconds / source_mb if source_mb else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_benchmark(storage_config, corpora, levels, concurrencies, scale,
+                  corpus_dir):
+    results = []
+    for corpus in corpora:
+        directory = os.path.join(corpus_dir, corpus)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        logger.info('Generating %s corpus' % corpus)
+        paths = make_corpus(directory, corpus, scale)
+        for level in levels:
+            for concurrency in concurrencies:
+                logger.info('Uploading %s, level %s, concurrency %d' %
+                            (corpus, level_name(level), concurrency))
+                pool = Pool(1)
+                try:
+                    result = pool.apply(run_scenario,
+                                        (storage_config, paths, level,
+                                         concurrency))
+                finally:
+                    pool.close()
+                    pool.join()
+                result.update({'corpus': corpus,
+                               'level': level,
+                               'concurrency': concurrency})
+                results.append(result)
+    return results
+
+
+def print_report(results):
+    print '%-12s %7s %4s %6s %9s %9s %8s %8s %8s' % (
+        'corpus', 'level', 'conc', 'files', 'source', 'stored', 'MB/s',
+        'cpu s/MB', 'rss MB')
+    for r in results:
+        print '%-12s %7s %4d %6d %8.1fM %8.1fM %8.2f %8.3f %8.1f' % (
+            r['corpus'], level_name(r['level']), r['concurrency'], r['files'],
+            r['source_mb'], r['stored_mb'], r['mb_per_second'],
+            r['cpu_seconds_per_mb'], r['peak_rss_mb'])
+
+
+def level_name(level):
+    return 'default' if level is None else str(level)
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def level_list(value):
+    return [None if v == 'default' else int(v)
+            for v in value.split(',') if v]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Storage upload throughput benchmark')
+    parser.add_argument('--storage-config', default='',
+                        help='s3 credentials json file describing the '
+                             'backend; defaults to a local S3 stand-in.')
+    parser.add_argument('--corpora', default='logs,screenshots,mixed',
+                        help='Comma separated corpora to upload: %s.' %
+                             ', '.join(sorted(CORPORA)))
+    parser.add_argument('--levels', type=level_list, default=[None],
+                        help='Comma separated compression levels to try; '
+                             '"default" uses the size based default and 0 '
+                             'stores files uncompressed.')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 4],
+                        help='Comma separated numbers of concurrent '
+                             'uploads to try.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply the corpus file sizes by this.')
+    parser.add_argument('--corpus-dir', default='',
+                        help='Keep generated corpora here for reuse.')
+    parser.add_argument('--report', default='',
+                        help='Optional path of a json report.')
+    args = parser.parse_args(argv)
+
+    for corpus in args.corpora.split(','):
+        if corpus not in CORPORA:
+            parser.error('unknown corpus %s' % corpus)
+
+    temp_dirs = []
+    server = None
+    if args.storage_config:
+        with open(args.storage_config) as f:
+            storage_config = json.load(f)
+    else:
+        server = s3_standin.start_server()
+        storage_config = {'s3_bucket_name': 's3-benchmark',
+                          'aws_access_key_id': 'standin',
+                          'aws_access_key': 'standin',
+                          's3_endpoint': server.url}
+    corpus_dir = args.corpus_dir
+    if not corpus_dir:
+        temp_dirs.append(tempfile.mkdtemp(prefix='s3_benchmark_corpus'))
+        corpus_dir = temp_dirs[-1]
+
+    try:
+        results = run_benchmark(storage_config, args.corpora.split(','),
+                                args.levels, args.concurrency, args.scale,
+                                corpus_dir)
+    finally:
+        if server:
+            server.shutdown()
+        for directory in temp_dirs:
+            shutil.rmtree(directory, ignore_errors=True)
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=4, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Minimal local stand-in for the S3 requests made by S3Bucket, for
+benchmarks and manual testing without AWS. Point an s3 credentials json
+file's s3_endpoint at it; any bucket name and credentials are accepted.
+
+Serves path-style requests:
+    HEAD   /<bucket>/
+    GET    /<bucket>/?prefix=&delimiter=&marker=&max-keys=  (list keys)
+    POST   /<bucket>/?delete  (multi-object delete)
+    HEAD   /<bucket>/<key>
+    PUT    /<bucket>/<key>  (with x-amz-copy-source: copy an object)
+    DELETE /<bucket>/<key>
+    POST   /<bucket>/<key>?uploads  (initiate multipart upload)
+    PUT    /<bucket>/<key>?partNumber=<n>&uploadId=<id>
+    GET    /<bucket>/<key>?uploadId=<id>  (list parts)
+    POST   /<bucket>/<key>?uploadId=<id>  (complete multipart upload)
+    DELETE /<bucket>/<key>?uploadId=<id>  (abort multipart upload)
+
+Only the names, sizes, etags and headers of objects are kept; their data is
+discarded.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import email.utils
+import hashlib
+import logging
+import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from xml.sax.saxutils import escape, unescape
+
+logging.basicConfig()
+logger = logging.getLogger('s3_standin')
+logger.setLevel(logging.INFO)
+
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+# Object headers kept and returned by HEAD requests
+KEPT_HEADERS = ('content-type', 'content-encoding')
+MAX_KEYS = 1000
+RE_PART_ETAG = re.compile(r'<ETag>"?([0-9a-f]+)"?</ETag>')
+
+
+class StoredObject(object):
+    __slots__ = ('size', 'etag', 'modified', 'headers')
+
+    def __init__(self, size, etag, headers):
+        self.size = size
+        self.etag = etag
+        self.modified = time.time()
+        self.headers = headers
+
+
+class StandinS3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        HTTPServer.__init__(self, address, StandinS3RequestHandler)
+        self.lock = threading.Lock()
+        # bucket -> key name -> StoredObject
+        self.buckets = {}
+        # upload id -> (bucket, key name, headers, {part number: (size, md5)})
+        self.uploads = {}
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def bucket(self, name):
+        """ Return the objects of bucket `name`, creating it if need be.
+        Call with the lock held.
+        """
+        return self.buckets.setdefault(name, {})
+
+
+class StandinS3RequestHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests, like S3, without delaying
+    # small responses
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _parse(self):
+        parsed = urlparse.urlparse(self.path)
+        parts = parsed.path.lstrip('/').split('/', 1)
+        self.bucket_name = parts[0]
+        self.key_name = urllib.unquote(parts[1]) if len(parts) > 1 else ''
+        self.query = dict((name, values[0]) for name, values in
+                          urlparse.parse_qs(parsed.query,
+                                            keep_blank_values=True).items())
+
+    def _read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        return self.rfile.read(length)
+
+    def _respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, status, root, content):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<%s xmlns="%s">%s</%s>' % (root, S3_XMLNS, content, root))
+        self._respond(status, body)
+
+    def _error(self, status, code, message):
+        if self.command == 'HEAD':
+            self._respond(status)
+            return
+        self._xml(status, 'Error', '<Code>%s</Code><Message>%s</Message>' %
+                  (code, escape(message)))
+
+    def _no_such_upload(self):
+        self._error(404, 'NoSuchUpload', 'The specified upload does not '
+                                         'exist.')
+
+    def do_HEAD(self):
+        self._parse()
+        if not self.key_name:
+            self._respond(200)
+            return
+        with self.server.lock:
+            obj = self.server.bucket(self.bucket_name).get(self.key_name)
+        if not obj:
+            self._respond(404)
+            return
+        headers = dict(obj.headers)
+        headers.update({'ETag': '"%s"' % obj.etag,
+                        'Last-Modified': email.utils.formatdate(
+                            obj.modified, usegmt=True)})
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(obj.size))
+        self.end_headers()
+
+    def do_GET(self):
+        self._parse()
+        if self.key_name and 'uploadId' in self.query:
+            self._list_parts()
+        elif not self.key_name:
+            self._list_keys()
+        else:
+            self._error(501, 'NotImplemented', 'Object data is not kept.')
+
+    def do_PUT(self):
+        self._parse()
+        body = self._read_body()
+        if self.headers.getheader('x-amz-copy-source'):
+            self._copy_object()
+            return
+        md5 = hashlib.md5(body).hexdigest()
+        if 'uploadId' in self.query:
+            with self.server.lock:
+                upload = self.server.uploads.get(self.query['uploadId'])
+                if upload:
+                    upload[3][int(self.query['partNumber'])] = (len(body),
+                                                               md5)
+            if not upload:
+                self._no_such_upload()
+                return
+        else:
+            headers = dict((name, self.headers.getheader(name))
+                           for name in KEPT_HEADERS
+                           if self.headers.getheader(name))
+            with self.server.lock:
+                self.server.bucket(self.bucket_name)[self.key_name] = (
+                    StoredObject(len(body), md5, headers))
+        self._respond(200, headers={'ETag': '"%s"' % md5})
+
+    def do_POST(self):
+        self._parse()
+        body = self._read_body()
+        if not self.key_name and 'delete' in self.query:
+            self._delete_keys(body)
+        elif 'uploads' in self.query:
+            self._initiate_upload()
+        elif 'uploadId' in self.query:
+            self._complete_upload(body)
+        else:
+            self._error(501, 'NotImplemented', 'Unsupported request.')
+
+    def do_DELETE(self):
+        self._parse()
+        with self.server.lock:
+            if 'uploadId' in self.query:
+                self.server.uploads.pop(self.query['uploadId'], None)
+            else:
+                self.server.bucket(self.bucket_name).pop(self.key_name, None)
+        self._respond(204)
+
+    def _copy_object(self):
+        source = urllib.unquote(
+            self.headers.getheader('x-amz-copy-source').split('?')[0])
+        bucket_name, key_name = source.lstrip('/').split('/', 1)
+        with self.server.lock:
+            obj = self.server.bucket(bucket_name).get(key_name)
+            if obj:
+                headers = obj.headers
+                if (self.headers.getheader('x-amz-metadata-directive') ==
+                        'REPLACE'):
+                    headers = dict((name, self.headers.getheader(name))
+                                   for name in KEPT_HEADERS
+                                   if self.headers.getheader(name))
+                obj = StoredObject(obj.size, obj.etag, headers)
+                self.server.bucket(self.bucket_name)[self.key_name] = obj
+        if not obj:
+            self._error(404, 'NoSuchKey', 'The specified key does not '
+                                          'exist.')
+            return
+        self._xml(200, 'CopyObjectResult',
+                  '<LastModified>%s</LastModified><ETag>"%s"</ETag>' %
+                  (time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                 time.gmtime(obj.modified)), obj.etag))
+
+    def _list_keys(self):
+        prefix = self.query.get('prefix', '')
+        delimiter = self.query.get('delimiter', '')
+        marker = self.query.get('marker', '')
+        max_keys = min(int(self.query.get('max-keys') or MAX_KEYS), MAX_KEYS)
+        with self.server.lock:
+            objects = sorted(self.server.bucket(self.bucket_name).items())
+        contents = []
+        prefixes = []
+        truncated = False
+        for name, obj in objects:
+            if not name.startswith(prefix) or name <= marker:
+                continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            if delimiter:
+                i = name.find(delimiter, len(prefix))
+                if i >= 0:
+                    common = name[:i + len(delimiter)]
+                    if common not in prefixes:
+                        prefixes.append(common)
+                    continue
+            contents.append(
+                '<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                '<ETag>"%s"</ETag><Size>%d</Size>'
+                '<StorageClass>STANDARD</StorageClass></Contents>' %
+                (escape(name),
+                 time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                               time.gmtime(obj.modified)),
+                 obj.etag, obj.size))
+        self._xml(200, 'ListBucketResult',
+                  '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>'
+                  '<MaxKeys>%d</MaxKeys><Delimiter>%s</Delimiter>'
+                  '<IsTruncated>%s</IsTruncated>%s%s' %
+                  (escape(self.bucket_name), escape(prefix), escape(marker),
+                   max_keys, escape(delimiter),
+                   'true' if truncated else 'false', ''.join(contents),
+                   ''.join('<CommonPrefixes><Prefix>%s</Prefix>'
+                           '</CommonPrefixes>' % escape(p)
+                           for p in prefixes)))
+
+    def _delete_keys(self, body):
+        names = [unescape(n) for n in re.findall(r'<Key>(.*?)</Key>', body)]
+        quiet = '<Quiet>true</Quiet>' in body
+        with self.server.lock:
+            bucket = self.server.bucket(self.bucket_name)
+            for name in names:
+                bucket.pop(name, None)
+        deleted = '' if quiet else ''.join(
+            '<Deleted><Key>%s</Key></Deleted>' % escape(name)
+            for name in names)
+        self._xml(200, 'DeleteResult', deleted)
+
+    def _initiate_upload(self):
+        upload_id = uuid.uuid4().hex
+        headers = dict((name, self.headers.getheader(name))
+                       for name in KEPT_HEADERS
+                       if self.headers.getheader(name))
+        with self.server.lock:
+            self.server.uploads[upload_id] = (self.bucket_name,
+                                              self.key_name, headers, {})
+        self._xml(200, 'InitiateMultipartUploadResult',
+                  '<Bucket>%s</Bucket><Key>%s</Key>'
+                  '<UploadId>%s</UploadId>' %
+                  (escape(self.bucket_name), escape(self.key_name),
+                   upload_id))
+
+    def _list_parts(self):
+        with self.server.lock:
+            upload = self.server.uploads.get(self.query['uploadId'])
+            parts = sorted(upload[3].items()) if upload else None
+        if upload is None:
+            self._no_such_upload()
+            return
+        self._xml(200, 'ListPartsResult',
+                  '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                  '<IsTruncated>false</IsTruncated>%s' %
+                  (escape(self.bucket_name), escape(self.key_name),
+                   self.query['uploadId'],
+                   ''.join('<Part><PartNumber>%d</PartNumber>'
+                           '<ETag>"%s"</ETag><Size>%d</Size></Part>' %
+                           (number, md5, size)
+                           for number, (size, md5) in parts)))
+
+    def _complete_upload(self, body):
+        with self.server.lock:
+            upload = self.server.uploads.pop(self.query['uploadId'], None)
+            if upload:
+                bucket_name, key_name, headers, parts = upload
+                md5s = RE_PART_ETAG.findall(body)
+                if len(md5s) != len(parts):
+                    self.server.uploads[self.query['uploadId']] = upload
+                    upload = None
+                else:
+                    # S3 etags of multipart objects are the md5 of the
+                    # part md5s followed by the number of parts
+                    etag = '%s-%d' % (hashlib.md5(
+                        ''.join(md5.decode('hex') for md5 in md5s)
+                    ).hexdigest(), len(md5s))
+                    self.server.bucket(bucket_name)[key_name] = StoredObject(
+                        sum(size for size, _ in parts.values()), etag,
+                        headers)
+        if not upload:
+            self._error(400, 'InvalidPart', 'Parts do not match the upload.')
+            return
+        self._xml(200, 'CompleteMultipartUploadResult',
+                  '<Location>%s/%s/%s</Location><Bucket>%s</Bucket>'
+                  '<Key>%s</Key><ETag>"%s"</ETag>' %
+                  (self.server.url, escape(bucket_name),
+                   escape(urllib.quote(key_name)), escape(bucket_name),
+                   escape(key_name), etag))
+
+
+def start_server(host='127.0.0.1', port=0):
+    """ Start a StandinS3Server in a background thread and return it. """
+    server = StandinS3Server((host, port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('S3 stand-in listening on %s' % server.url)
+    return server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the S3 API used by S3Bucket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = StandinS3Server((args.host, args.port))
+    logger.info('S3 stand-in listening on %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local stand-in for the Treeherder API endpoints used by
+TreeherderSubmission, and a load-test harness that drives submit_running and
+submit_complete against it.
+
+Serves:
+    GET  /api/project/<project>/resultset/?revision=<rev>
+    GET  /api/project/<project>/jobs/?job_guid=<guid>
+    GET  /api/project/<project>/jobs/?job_guid__in=<guid>,<guid>,...
+    POST /api/project/<project>/jobs/  (job collection)
+
+Latency, error rate and timeouts can be injected to exercise retries.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+
+logging.basicConfig()
+logger = logging.getLogger('treeherder_standin')
+logger.setLevel(logging.INFO)
+
+RE_API_PATH = re.compile(r'^/api/project/(?P<project>[^/]+)/'
+                         r'(?P<endpoint>resultset|jobs)/$')
+
+
+class StandinConfig(object):
+    """ Fault injection settings shared by all request handlers. """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 timeout_rate=0.0, timeout_delay=30.0):
+        self.latency = latency  # seconds added to every response
+        self.jitter = jitter  # up to this many seconds added at random
+        self.error_rate = error_rate  # fraction of requests answered with 500
+        self.timeout_rate = timeout_rate  # fraction of requests delayed
+        self.timeout_delay = timeout_delay  # seconds a delayed request waits
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        HTTPServer.__init__(self, address, StandinRequestHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        # job_guid -> job id
+        self.jobs = {}
+        self.posted_collections = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def add_jobs(self, guids):
+        with self.lock:
+            self.posted_collections += 1
+            for guid in guids:
+                if guid not in self.jobs:
+                    self.jobs[guid] = len(self.jobs) + 1
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _inject_faults(self):
+        """ Delay the response as configured; return False if the request
+        should fail with an error instead.
+        """
+        config = self.server.config
+        delay = config.latency + random.uniform(0, config.jitter)
+        if random.random() < config.timeout_rate:
+            delay += config.timeout_delay
+        if delay:
+            time.sleep(delay)
+        if random.random() < config.error_rate:
+            self._respond(500, {'detail': 'injected error'})
+            return False
+        return True
+
+    def _respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        parsed = urlparse.urlparse(self.path)
+        match = RE_API_PATH.match(parsed.path)
+        if not match:
+            self._respond(404, {'detail': 'Not found.'})
+            return None, None, None
+        return (match.group('project'), match.group('endpoint'),
+                urlparse.parse_qs(parsed.query))
+
+    def do_GET(self):
+        project, endpoint, query = self._route()
+        if not project or not self._inject_faults():
+            return
+        if endpoint == 'resultset':
+            revision = query.get('revision', [''])[0]
+            revision_hash = hashlib.sha1(project + revision).hexdigest()
+            self._respond(200, {'results': [{'id': 1,
+                                             'revision': revision,
+                                             'revision_hash': revision_hash}]})
+            return
+        guids = query.get('job_guid', [])
+        for value in query.get('job_guid__in', []):
+            guids.extend(value.split(','))
+        with self.server.lock:
+            results = [{'id': self.server.jobs[guid], 'job_guid': guid}
+                       for guid in guids if guid in self.server.jobs]
+        self._respond(200, {'results': results})
+
+    def do_POST(self):
+        project, endpoint, query = self._route()
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        if not project or not self._inject_faults():
+            return
+        if endpoint != 'jobs':
+            self._respond(405, {'detail': 'Method not allowed.'})
+            return
+        try:
+            collection = json.loads(body)
+        except ValueError:
+            self._respond(400, {'detail': 'Malformed JSON.'})
+            return
+        self.server.add_jobs(item.get('job', {}).get('job_guid')
+                             for item in collection)
+        self._respond(200, {'message': 'well-formed JSON stored'})
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    """ Start a StandinServer in a background thread and return it. """
+    server = StandinServer((host, port), config)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Treeherder stand-in listening on %s' % server.url)
+    return server
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_load(url, num_jobs, concurrency, retries=5, retry_wait=0,
+             timeout=10):
+    """ Submit `num_jobs` jobs as running then completed, `concurrency` at a
+    time, against the Treeherder instance at `url`. Return a report dict.
+    """
+    from treeherding import TestJob, TreeherderOptions, TreeherderSubmission
+
+    options = TreeherderOptions()
+    options.treeherder_url = url
+    options.treeherder_credentials = {'client_id': 'standin',
+                                      'secret': 'standin'}
+    options.treeherder_retries = retries
+    options.treeherder_retry_wait = retry_wait
+    options.treeherder_timeout = timeout
+    options.treeherder_resolve_job_urls = False
+    submission_logger = logging.getLogger('treeherder_standin.submission')
+    submission_logger.setLevel(logging.WARNING)
+    treeherder = TreeherderSubmission(submission_logger, options)
+
+    latencies = {'submit_running': [], 'submit_complete': []}
+    errors = {'submit_running': 0, 'submit_complete': 0}
+    lock = threading.Lock()
+    queue = range(num_jobs)
+
+    def make_job(i):
+        job = TestJob()
+        job.name = job.job_name = 'load test %d' % i
+        job.job_symbol = 'l'
+        job.group_name = 'Load Test'
+        job.group_symbol = 'LT'
+        job.description = 'treeherder_standin load test'
+        job.reason = 'scheduled'
+        job.who = 'PlatformQuality'
+        job.build.update({'repo': 'mozilla-central',
+                          'release': 'Nightly',
+                          'revision': '%040x' % i,
+                          'build_id': '20150520030205',
+                          'os_name': 'linux',
+                          'platform': 'linux64',
+                          'architecture': 'x86_64'})
+        job.machine.update({'os_name': 'linux',
+                            'platform': 'linux64',
+                            'architecture': 'x86_64',
+                            'host': 'standin-%d' % (i % concurrency)})
+        job.result = 'success'
+        return job
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                i = queue.pop()
+            job = make_job(i)
+            for name in ('submit_running', 'submit_complete'):
+                start = time.time()
+                try:
+                    # False for a failed post or a missing revision hash
+                    failed = not getattr(treeherder, name)([job])
+                except Exception:
+                    # e.g. a lookup that timed out; submission gives up
+                    logger.debug('%s failed' % name, exc_info=True)
+                    failed = True
+                if failed:
+                    with lock:
+                        errors[name] += 1
+                elapsed = time.time() - start
+                with lock:
+                    latencies[name].append(elapsed)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+
+    report = {
+        'jobs': num_jobs,
+        'concurrency': concurrency,
+        'duration': duration,
+        'jobs_per_second': num_jobs / duration if duration else 0.0,
+        'operations': {},
+        'metrics': treeherder.metrics.as_dict()['endpoints'],
+    }
+    for name, values in latencies.items():
+        report['operations'][name] = {
+            'count': len(values),
+            'errors': errors[name],
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else 0.0,
+        }
+    return report
+
+
+def print_report(report):
+    print 'jobs: %(jobs)d  concurrency: %(concurrency)d' % report
+    print 'duration: %(duration).2fs  throughput: %(jobs_per_second).2f jobs/s' % report
+    print '%-16s %6s %6s %8s %8s %8s %8s' % ('operation', 'count', 'errors',
+                                             'p50', 'p90', 'p99', 'max')
+    for name in ('submit_running', 'submit_complete'):
+        op = report['operations'][name]
+        print '%-16s %6d %6d %7.3fs %7.3fs %7.3fs %7.3fs' % (
+            name, op['count'], op['errors'], op['p50'], op['p90'], op['p99'],
+            op['max'])
+    for endpoint, e in sorted(report['metrics'].items()):
+        print '%-16s requests: %d retries: %d failures: %d bytes: %d' % (
+            endpoint, e['requests'], e['retries'], e['failures'],
+            e['bytes_sent'])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Local Treeherder stand-in and submission load test')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--serve-only', action='store_true',
+                        help='Only run the stand-in server.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many random seconds added.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with HTTP 500.')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='Fraction of requests delayed by --timeout-delay.')
+    parser.add_argument('--timeout-delay', type=float, default=30.0)
+    parser.add_argument('--jobs', type=int, default=100,
+                        help='Number of jobs to submit.')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Number of jobs submitted concurrently.')
+    parser.add_argument('--client-timeout', type=float, default=10.0,
+                        help='Timeout of submission requests in seconds.')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--retry-wait', type=float, default=0.0)
+    parser.add_argument('--report', default='',
+                        help='Optional path of a json report.')
+    args = parser.parse_args(argv)
+
+    config = StandinConfig(latency=args.latency,
+                           jitter=args.jitter,
+                           error_rate=args.error_rate,
+                           timeout_rate=args.timeout_rate,
+                           timeout_delay=args.timeout_delay)
+    if args.serve_only:
+        server = StandinServer((args.host, args.port), config)
+        logger.info('Treeherder stand-in listening on %s' % server.url)
+        server.serve_forever()
+        return
+
+    server = start_server(config, args.host, args.port)
+    report = run_load(server.url, args.jobs, args.concurrency,
+                      retries=args.retries, retry_wait=args.retry_wait,
+                      timeout=args.client_timeout)
+    server.shutdown()
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])